@@ -0,0 +1,156 @@
+import os
+import subprocess
+import threading
+from dotenv import load_dotenv
+import cache
+import demux
+import media_probe
+
+
+load_dotenv()
+
+# ========== CONFIGURATION ==========
+FFMPEG = os.getenv("FFMPEG") or "ffmpeg"
+EAC3TO = os.getenv("EAC3TO") or "eac3to"
+QAAC = os.getenv("QAAC") or "qaac64"
+
+# AC3 bitrate (Kbps) of surround deliverables per resolution; anything not listed gets the default
+AC3_BITRATES = {"480p": 448, "576p": 448}
+DEFAULT_AC3_BITRATE = 640
+
+# AC3 carries at most 5.1; 6.1/7.1 tracks are downmixed
+AC3_MAX_CHANNELS = 6
+
+
+# ====================================
+
+def ac3_bitrate(res):
+    return AC3_BITRATES.get(res, DEFAULT_AC3_BITRATE)
+
+
+def variant_for(stream, res):
+    """
+    Name of the audio deliverable a resolution gets from the best track:
+    "copy" when the track already is AC3 (surround) or AAC (stereo/mono),
+    otherwise "ac3-<kbps>" for surround and "aac" (qaac) for stereo/mono.
+    """
+    codec = media_probe.audio_codec(stream)
+    if int(stream.get("channels") or 0) > 2:
+        return "copy" if codec == "AC3" else f"ac3-{ac3_bitrate(res)}"
+    return "copy" if codec == "AAC" else "aac"
+
+
+def variant_path(input_file, audio_file, variant):
+    if variant == "copy":
+        return audio_file
+    base_name = os.path.splitext(os.path.basename(input_file))[0]
+    ext = "m4a" if variant == "aac" else "ac3"
+    return cache.scratch_path(input_file, "audio", f"{base_name}-{variant}.{ext}")
+
+
+def part_path(path):
+    """Where an output is written before it is moved into place, keeping its extension."""
+    root, ext = os.path.splitext(path)
+    return f"{root}.part{ext}"
+
+
+def encode_ac3(audio_file, outputs, channels):
+    """
+    Encode every AC3 bitrate in `outputs` ({kbps: path}) with one ffmpeg run:
+    the track is decoded once and split into one encoder per bitrate.
+    """
+    bitrates = sorted(outputs)
+    cmd = [FFMPEG, "-hide_banner", "-v", "error", "-y", "-i", audio_file]
+    if len(bitrates) > 1:
+        labels = [f"[a{i}]" for i in range(len(bitrates))]
+        cmd += ["-filter_complex", f"[0:a]asplit={len(bitrates)}{''.join(labels)}"]
+    else:
+        labels = ["0:a"]
+    for label, bitrate in zip(labels, bitrates):
+        cmd += [
+            "-map", label,
+            "-c:a", "ac3", "-b:a", f"{bitrate}k",
+            "-ac", str(min(channels, AC3_MAX_CHANNELS)),
+            part_path(outputs[bitrate]),
+        ]
+    print("Running command:", " ".join(cmd))
+    result = subprocess.run(cmd, capture_output=True, text=True, encoding="utf-8", errors="ignore")
+    if result.returncode != 0:
+        for path in outputs.values():
+            if os.path.exists(part_path(path)):
+                os.remove(part_path(path))
+        raise RuntimeError(f"AC3 encode failed: {result.stderr.strip()}")
+    for path in outputs.values():
+        os.replace(part_path(path), path)
+
+
+def encode_aac(audio_file, output_file):
+    """
+    Stereo/mono AAC with qaac, fed eac3to's decode of the track as WAV over a pipe:
+    both run at once and no intermediate file is written. Fails with the errors of
+    whichever end broke.
+    """
+    decoder = subprocess.Popen([EAC3TO, audio_file, "stdout.wav"], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    encoder = subprocess.Popen(
+        [QAAC, "-V", "127", "--no-delay", "--ignorelength", "-o", part_path(output_file), "-"],
+        stdin=decoder.stdout, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+    )
+    # qaac holds the read end now; if it dies eac3to gets a broken pipe instead of blocking
+    decoder.stdout.close()
+
+    decoder_log = []
+    reader = threading.Thread(target=lambda: decoder_log.append(decoder.stderr.read()), daemon=True)
+    reader.start()
+    encoder_log = encoder.communicate()[0].decode("utf-8", errors="ignore")
+    reader.join()
+    decoder.wait()
+    decoder_log = b"".join(decoder_log).decode("utf-8", errors="ignore")
+    print(encoder_log)
+
+    errors = []
+    if decoder.returncode != 0:
+        errors.append(f"eac3to exited with {decoder.returncode}: {decoder_log.strip()[-500:]}")
+    if encoder.returncode != 0:
+        errors.append(f"qaac exited with {encoder.returncode}: {encoder_log.strip()[-500:]}")
+    if errors or not os.path.exists(part_path(output_file)):
+        if os.path.exists(part_path(output_file)):
+            os.remove(part_path(output_file))
+        raise RuntimeError("; ".join(errors) or "qaac produced no output")
+    os.replace(part_path(output_file), output_file)
+
+
+def prepare_audio(input_file, resolutions, demuxed=None):
+    """
+    Produce the audio deliverable of every resolution from the job's best track
+    (see demux.demux_tracks) in one audio stage:
+    - Surround: AC3 at each resolution's bitrate, all from a single decode
+    - Stereo/mono: one qaac AAC shared by every resolution
+    - Tracks already in the delivery codec are used as demuxed
+    Outputs live in the source's scratch space, so a resolution (or a rerun of the
+    job) whose variant exists just picks it up. They start at the track's first
+    sample; its delay against the video is applied when muxing (demuxed["audio_delay"]).
+    Returns {res: [audio paths]}, with empty lists when the source has no audio.
+    """
+    demuxed = demuxed or demux.demux_tracks(input_file)
+    stream = demuxed["audio_stream"]
+    if not stream:
+        print("⚠️ No audio tracks found!")
+        return {res: [] for res in resolutions}
+    audio_file = demuxed["audio"]
+    print(f"🎯 Best track: {stream['index']} - {media_probe.describe_audio(stream)}")
+
+    variants = {res: variant_for(stream, res) for res in resolutions}
+    paths = {variant: variant_path(input_file, audio_file, variant) for variant in set(variants.values())}
+    missing = {variant for variant, path in paths.items() if not os.path.exists(path)}
+    for variant in sorted(set(paths) - missing - {"copy"}):
+        print(f"♻️ Reusing {variant} audio")
+
+    ac3_outputs = {int(v.split("-")[1]): paths[v] for v in missing if v.startswith("ac3-")}
+    if ac3_outputs:
+        print(f"🔧 Encoding AC3 at {', '.join(f'{b} Kbps' for b in sorted(ac3_outputs))} from one decode...")
+        encode_ac3(audio_file, ac3_outputs, int(stream.get("channels") or AC3_MAX_CHANNELS))
+    if "aac" in missing:
+        print("🔧 Encoding AAC (eac3to → qaac)...")
+        encode_aac(audio_file, paths["aac"])
+
+    return {res: [paths[variant]] for res, variant in variants.items()}
@@ -5,12 +5,31 @@ import threading
 import subprocess
 import time
 import re
+import shutil
+import math
 import requests
-from pymkv import MKVFile
 import numpy as np
 from imdb import IMDb, IMDbError
 import json
 import config
+import frames
+import cropdetect
+import cache
+import cq_search
+import preview_executor
+import bitrate_cache
+import preview_clips
+import chunked_encode
+import coordinator
+import bitrate_projection
+import encoders
+import job_history
+import source_index
+import media_probe
+import demux
+import audio
+import ladder_encode
+import stage_scheduler
 import cv2
 from dotenv import load_dotenv
 import logging
@@ -23,12 +42,10 @@ sys.stdout.reconfigure(encoding='utf-8')
 
 # ----------------- Configuration -----------------
 load_dotenv()
-HANDBRAKE_CLI = os.getenv("HANDBRAKE_CLI")
 DISCORD_WEBHOOK_URL = os.getenv("DISCORD_WEBHOOK_URL")
 FFMPEG = os.getenv("FFMPEG")
 FFPROBE = os.getenv("FFPROBE")
 MEDIAINFO_PATH = os.getenv("MEDIAINFO_PATH")
-MKVEXTRACT = os.getenv("MKVEXTRACT")
 PTPIMG_API_KEY = os.getenv("API_KEY")
 UPLOAD_TO_PTPIMG = True
 
@@ -45,25 +62,75 @@ BITRATE_RANGES = {
         "720p": (5000, 7000),
 }
 
-cropping_start_times = [300, 1000, 1500, 2500]
+crop_sample_frames = 100
 
+CROP_CACHE_FILE = "crops.json"
+# Bump when the fields stored per crop change, so older entries are detected again
+CROP_CACHE_VERSION = 2
+
+# Subdirectory of the cache directory holding one decoded snapshot frame per cached crop
+CROP_FRAME_DIR = "crop_frames"
+
+# Snapshot frames (a few MB each) beyond this count, least recently used first, are evicted
+CROP_FRAME_MAX_ENTRIES = int(os.getenv("CROP_FRAME_CACHE_MAX_ENTRIES") or 200)
+
+# Snapshot frames not used for this many days are evicted
+CROP_FRAME_MAX_AGE_DAYS = float(os.getenv("CROP_FRAME_CACHE_MAX_AGE_DAYS") or 90)
+
+# Fixed preview sections, used when the source has no analysis index
 encode_preview_start_section = ["seconds:300", "seconds:1500", "seconds:2500"]
 
+encode_preview_duration = 100
+
+# With an analysis index: this many complexity-stratified windows of this many seconds
+preview_window_count = 4
+
+preview_window_duration = 30
+
 cq_range = [9, 27]
 
+cq_search_max_probes = 3
+
+cq_candidates_per_round = 1
+
+# Full-quality confirmations allowed when searching on proxy previews (PREVIEW_PROXY_PRESET)
+proxy_confirm_rounds = 2
+
 encoding_source_format = None
 
 APPROVAL_FILENAME = "approval.txt"
 
 STATUS_FILE = 'status.json'
 
+# "crf" (CQ search + constant quality), "crf-vbv" (same, VBV capped at the window) or "2pass" (ABR at the window midpoint)
+FINAL_ENCODE_MODES = ("crf", "crf-vbv", "2pass")
+FINAL_ENCODE_MODE = os.getenv("FINAL_ENCODE_MODE") or "crf"
+
+# Split the final encode into this many keyframe-aligned chunks encoded in parallel (1 = single HandBrake run)
+final_encode_chunks = int(os.getenv("FINAL_ENCODE_CHUNKS") or 1)
+
+# Encode all resolutions of a job from a single decode of the source with ffmpeg/libx264 (crf modes only)
+final_encode_ladder = os.getenv("FINAL_ENCODE_LADDER") == "1"
+
+# Encode a single-run final encode as this many checkpointed segments, one after another,
+# so a stopped or crashed job resumes where it left off (0 = one uninterrupted HandBrake run)
+final_encode_segments = int(os.getenv("FINAL_ENCODE_SEGMENTS") or 0)
+
 
 # ----------------- Utility Functions -----------------
 
+# Stages of a job update the status file concurrently
+status_lock = threading.Lock()
+
 def update_resolution_status(job_id, filename, resolution, status, progress):
     """
     Update the status of the encoding job in the status file.
     """
+    with status_lock:
+        write_resolution_status(job_id, filename, resolution, status, progress)
+
+
+def write_resolution_status(job_id, filename, resolution, status, progress):
     if os.path.exists(STATUS_FILE):
         with open(STATUS_FILE, 'r', encoding='utf-8') as f:
             status_data = json.load(f)
@@ -117,14 +184,9 @@ def send_webhook_message(message):
 
 def get_bitrate(output_file):
     try:
-        cmd = [
-            FFPROBE, "-v", "error", "-select_streams", "v:0",
-            "-show_entries", "format=bit_rate",
-            "-of", "default=noprint_wrappers=1:nokey=1",
-            output_file
-        ]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        bitrate = int(result.stdout.strip()) // 1000
+        bitrate = media_probe.bitrate_kbps(output_file)
+        if bitrate is None:
+            raise ValueError("no bitrate in container")
         log(f"Bitrate is {bitrate} Kbps")
         return bitrate
     except Exception as e:
@@ -133,384 +195,463 @@ def get_bitrate(output_file):
 
 # ----------------- Cropping Functions -----------------
 
-def make_even(value):
-    return value if value % 2 == 0 else value + 1
-
-def detect_black_bars(frame):
-    gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-    _, thresh = cv2.threshold(gray, 5, 255, cv2.THRESH_BINARY)
-    contours, _ = cv2.findContours(thresh, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-    x, y, w, h = cv2.boundingRect(np.vstack(contours))
-    return x, y, w, h
-
-
-def extract_frame(input_file, start_time, temp_frame):
-    print("Getting frame")
-    ffmpeg_cmd = [
-        "ffmpeg", "-i", input_file, "-ss", str(start_time), "-vframes", "1", "-y", temp_frame
-    ]
-
-    process = subprocess.run(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-
-
-
-def get_cropping(settings, input_file, cropped_image, res, cq=17):
+def detect_source_crop(input_file):
+    """
+    Detect the crop of a source once and keep it in the on-disk cache.
+    The crop does not depend on the output resolution, so every resolution of the
+    ladder, and any re-run of the same source, reuses the stored detection.
+    With a source analysis index the vote runs over its profiles instead of decoding
+    sampled frames.
+    """
+    index = source_index.load_index(input_file)
+    params = dict(cropdetect.detector_params(), frames=crop_sample_frames, schema=CROP_CACHE_VERSION,
+                  index=source_index.INDEX_VERSION if index else None)
+    key = f"{cache.source_fingerprint(input_file)}:{cache.params_key(params)}"
+    cache_file = cache.cache_path(CROP_CACHE_FILE)
+
+    cached = cache.load_json(cache_file, {}).get(key)
+    if cached:
+        log(f"♻️ Reusing cached crop for {os.path.basename(input_file)}")
+        return cached
+
+    if index:
+        print(f"Voting crop over {len(index.profile_frames())} indexed profiles")
+        detection = index.detect_crop()
+        detection["snapshot_time"] = index.best_lit_time()
+    else:
+        # Sample frames across the whole film and vote the crop over all of them
+        reader = frames.FrameReader(input_file, pix_fmt="gray")
+        start_times = frames.sample_timestamps(frames.probe_duration(input_file), crop_sample_frames)
+        print(f"Extracting {len(start_times)} frames")
+        sampled_frames = reader.grab_many(start_times)
+
+        detection = cropdetect.detect_crop(sampled_frames)
+        detection["snapshot_time"] = start_times[cropdetect.best_lit_frame(sampled_frames)]
+    detection["key"] = key
+    crop = detection["crop"]
+    print(f"Crop values over {detection['frames']} frames (confidence {detection['confidence']}): ")
+    print(f"Top: {crop[0]}, Bottom: {crop[1]}, Left: {crop[2]}, Right: {crop[3]}")
+
+    # Re-read before writing so results stored by other jobs meanwhile are kept
+    crops = cache.load_json(cache_file, {})
+    crops[key] = detection
+    cache.save_json(cache_file, crops)
+    return detection
+
+
+def crop_snapshot_frame(input_file, detection):
+    """
+    Colour frame used for the crop approval snapshots.
+    It is decoded once per source at the best-lit crop sample and kept next to the
+    cached crop, so every resolution renders its snapshot without touching the source.
+    """
+    # The crop key is "<fingerprint>:<params>", and ":" is not allowed in Windows file names
+    frame_file = cache.cache_path(CROP_FRAME_DIR, f"{detection['key'].replace(':', '-')}.npy")
+    if os.path.exists(frame_file):
+        # A frame file's mtime records when it was last used
+        os.utime(frame_file)
+        return np.load(frame_file)
+
+    frame = frames.FrameReader(input_file, pix_fmt="bgr24").grab(detection["snapshot_time"]).copy()
+    np.save(frame_file, frame)
+    cache.evict_files(CROP_FRAME_DIR, CROP_FRAME_MAX_ENTRIES, CROP_FRAME_MAX_AGE_DAYS)
+    return frame
+
+
+def render_crop_snapshot(frame, crop, width, cropped_image):
+    """Apply the crop to a decoded frame and scale it to the target width, keeping the cropped aspect ratio."""
+    top, bottom, left, right = crop
+    height, full_width = frame.shape[:2]
+    cropped = frame[top:height - bottom, left:full_width - right]
+    target_height = cropdetect.make_even(round(width * cropped.shape[0] / cropped.shape[1]))
+    snapshot = cv2.resize(cropped, (width, target_height), interpolation=cv2.INTER_AREA)
+    cv2.imwrite(cropped_image, snapshot)
+
+
+def get_cropping(settings, input_file, cropped_image, res):
     send_webhook_message(f"Beginning Cropping for {input_file}")
 
     if not settings:
         log(f"❌ No settings found for {res}, skipping...")
         return None
 
-    # Define four start times for consistency check
-    start_times = cropping_start_times
-
-    crops = []
-
-    for start_time in start_times:
-        temp_frame = f'temp_frame_{start_time}_{res}.png'
-        print("Extracting frame")
-        extract_frame(input_file, start_time, temp_frame)
-        frame = cv2.imread(temp_frame)
-        x, y, w, h = detect_black_bars(frame)
-
-        # Calculate crop values
-        top_crop = make_even(y)
-        bottom_crop = make_even(frame.shape[0] - (y + h))
-        left_crop = make_even(x)
-        right_crop = make_even(frame.shape[1] - (x + w))
-
-        print(f"Crop values for frame at {start_time}s: ")
-        print(f"Top: {top_crop}, Bottom: {bottom_crop}, Left: {left_crop}, Right: {right_crop}")
-
-        crops.append((top_crop, bottom_crop, left_crop, right_crop))
-
-        # Compute median crop values for consistency
-    crops_array = np.array(crops)
-    median_crop = np.median(crops_array, axis=0).astype(int)
-    final_crop_values = f'{median_crop[0]}:{median_crop[1]}:{median_crop[2]}:{median_crop[3]}'
-
-    preview_file = f"preview_{res}.mkv"
-
-    command = [
-        HANDBRAKE_CLI,
-        "-i", input_file,
-        "-o", preview_file,
-        "--encoder", "x264",
-        "--quality", str(cq),
-        "--width", str(settings["width"]),
-        "--height", str(settings["height"]),
-        "--encoder-preset", "placebo",
-        "--encoder-profile", "high",
-        "--encoder-level", "4.1",
-        "--encopts",
-        ("subme=10:deblock=-3,-3:me=umh:merange=32:mbtree=0:"
-         "dct-decimate=0:fast-pskip=0:aq-mode=2:aq-strength=1.0:"
-         "qcomp=0.60:psy-rd=1.0,0.00"),
-        '--start-at', f'seconds:{start_times[1]}',  # Using the second start time for preview
-        '--stop-at', 'seconds:2',
-        "--crop", final_crop_values
-    ]
-
-    log(f"🎬 Encoding preview snapshot for {res}...")
-    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding="utf-8",
-                               errors="ignore")
-    for line in process.stdout:
-        sub_log(line, end="")
-    process.wait()
+    detection = detect_source_crop(input_file)
+    voted_crop = detection["crop"]
+    final_crop_values = f'{voted_crop[0]}:{voted_crop[1]}:{voted_crop[2]}:{voted_crop[3]}'
 
-    ffmpeg_cmd = [
-        "ffmpeg", "-ss", "1", "-i", preview_file, "-vframes", "1", "-y", cropped_image
-    ]
-    log(f"📸 Capturing cropped snapshot: {cropped_image}")
-    process = subprocess.Popen(ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
-    for line in process.stdout:
-        sub_log(line, end="")
-    process.wait()
+    log(f"📸 Rendering cropped snapshot for {res}: {cropped_image}")
+    frame = crop_snapshot_frame(input_file, detection)
+    render_crop_snapshot(frame, voted_crop, settings["width"], cropped_image)
     log(f"📷 Snapshot saved as {cropped_image}")
 
-    os.remove(preview_file)
-
     # Send final detected crop values to Discord
     discord_message = (
         f"📏 Final consistent cropping values for {res}:\n"
-        f"Top: {median_crop[0]}px\n"
-        f"Bottom: {median_crop[1]}px\n"
-        f"Left: {median_crop[2]}px\n"
-        f"Right: {median_crop[3]}px"
+        f"Top: {voted_crop[0]}px\n"
+        f"Bottom: {voted_crop[1]}px\n"
+        f"Left: {voted_crop[2]}px\n"
+        f"Right: {voted_crop[3]}px\n"
+        f"Confidence: {detection['confidence']:.0%}"
     )
     send_webhook_message(discord_message)
 
     return final_crop_values
 
 
-def encode_preview(input_file, res, cq, approved_crop):
+def section_seconds(start):
+    """Seconds offset of a HandBrake "seconds:N" start section."""
+    return int(start.split(":")[-1])
+
+
+def preview_sections(input_file):
+    """
+    Preview sections as ([start sections], seconds per section, {start: weight}).
+    With an analysis index they are complexity-stratified windows whose weights say
+    how much of the film each one stands for; otherwise the fixed sections, pulled
+    back inside the film on short titles, weighted equally.
+    """
+    index = source_index.load_index(input_file)
+    if index:
+        windows = index.preview_windows(preview_window_count, preview_window_duration)
+        sections = {f"seconds:{start}": weight for start, weight in windows}
+        return list(sections), preview_window_duration, sections
+
+    duration = frames.probe_duration(input_file)
+    latest = max(0, int(duration - encode_preview_duration))
+    starts = list(dict.fromkeys(min(section_seconds(start), latest) for start in encode_preview_start_section))
+    sections = [f"seconds:{start}" for start in starts]
+    return sections, encode_preview_duration, {start: 1 / len(sections) for start in sections}
+
+
+def encode_preview_section(input_file, res, cq, approved_crop, start, clip_file=None, threads=None, proxy=False,
+                           duration=encode_preview_duration):
+    """
+    Encode one preview section at one CQ and return its bitrate.
+    With `clip_file` the section is encoded from its pre-cut local clip instead of
+    seeking into the source. With `proxy` it runs the fast proxy settings.
+    """
+    settings = PRESET_SETTINGS.get(res)
+    preview_file = cache.scratch_path(input_file, "previews", f"preview_{res}_{section_seconds(start)}_cq{cq}.mkv")
+    backend = encoders.get_backend(encoders.PREVIEW_ENCODER)
+    preset, encopts = (encoders.PROXY_PRESET, encoders.PROXY_ENCOPTS) if proxy else (encoders.X264_PRESET, encoders.X264_ENCOPTS)
+
+    # Identical previews always produce the same bitrate, so re-runs reuse earlier measurements
+    # (`scale` changes whenever the backends' scaling does, e.g. ffmpeg once stretched cropped sources)
+    cache_params = {
+        "start": start, "duration": duration, "crop": approved_crop, "cq": cq,
+        "width": settings["width"], "height": settings["height"],
+        "preset": preset, "encopts": encopts, "clip": bool(clip_file),
+        "encoder": backend.name, "scale": encoders.scale_filter(settings["width"], settings["height"]),
+    }
+    cache_key = bitrate_cache.preview_key(input_file, **cache_params)
+    cached_bitrate = bitrate_cache.lookup(cache_key)
+    if cached_bitrate:
+        log(f"♻️ Cached preview bitrate for {res} with CQ {cq} @ {start}: {cached_bitrate} Kbps")
+        return cached_bitrate
+
+    command = backend.command(
+        clip_file or input_file, preview_file, approved_crop, settings["width"], settings["height"],
+        quality=cq, preset=preset, encopts=encopts, threads=threads,
+        start=None if clip_file else section_seconds(start), duration=duration,
+    )
+
+    log(f"\n🎬 Encoding {'proxy ' if proxy else ''}preview for {res} with CQ {cq} @ {start} seconds...\n")
+    remote = bool(coordinator.scratch_coordinator())
+    if remote:
+        try:
+            result = coordinator.run_remote("preview", backend.tool, command[1:], preview_file)
+            bitrate = result["bitrate"] if result else None
+        except coordinator.RemoteUnavailable as e:
+            log(f"⚠️ {e}, encoding the preview locally")
+            remote = False
+    if not remote:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding="utf-8", errors="ignore")
+        for line in process.stdout:
+            sub_log(line, end="")
+        process.wait()
+        bitrate = get_bitrate(preview_file)
+    if bitrate:
+        bitrate_cache.store(cache_key, bitrate, cache_params)
+    else:
+        log(f"⚠️ No valid bitrate found for preview @ {start} with CQ {cq}.")
+    if os.path.exists(preview_file):
+        os.remove(preview_file)
+    return bitrate
+
+
+def encode_previews(input_file, res, cqs, approved_crop, proxy=False):
+    """
+    Encode every preview section at each CQ concurrently and return {cq: average bitrate}.
+    All sections of all candidate CQs go into one bounded pool, so a round of probes
+    takes about as long as its slowest encode. The average is weighted by how much of
+    the film each section stands for.
+    """
     settings = PRESET_SETTINGS.get(res)
     if not settings:
         log(f"❌ No settings found for {res}, skipping...")
-        return None
+        return {}
 
-    start_section = encode_preview_start_section  # Start, Middle, End
-    bitrates = []
-    CQs = []
-
-    for start in start_section:
-        while True:
-            preview_file = f"preview_{res}_{start}.mkv"
-            command = [
-                HANDBRAKE_CLI,
-                "-i", input_file,
-                "-o", preview_file,
-                "--crop", approved_crop,
-                "--encoder", "x264",
-                "--quality", str(cq),
-                "--width", str(settings["width"]),
-                "--height", str(settings["height"]),
-                "--encoder-preset", "placebo",
-                "--encoder-profile", "high",
-                "--encoder-level", "4.1",
-                "--encopts",
-                ("subme=10:deblock=-3,-3:me=umh:merange=32:mbtree=0:"
-                 "dct-decimate=0:fast-pskip=0:aq-mode=2:aq-strength=1.0:"
-                 "qcomp=0.60:psy-rd=1.1,0.00"),
-                "--start-at", start,
-                "--stop-at", f'seconds:100'
-            ]
-
-            log(f"\n🎬 Encoding preview for {res} with CQ {cq} @ {start} seconds...\n")
-            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding="utf-8", errors="ignore")
-            for line in process.stdout:
-                sub_log(line, end="")
-            process.wait()
+    start_section, duration, weights = preview_sections(input_file)
 
-            bitrate = get_bitrate(preview_file)
-
-            if bitrate:
-                min_bitrate, max_bitrate = BITRATE_RANGES[res]
-                if bitrate < min_bitrate:
-                    cq -= 1
-                elif bitrate > max_bitrate:
-                    cq += 1
-                else:
-                    bitrates.append(bitrate)
-                    CQs.append(cq)
-                    break  # Move to the next section once it's in range
-            else:
-                log("⚠️ No valid bitrate found, retrying with adjusted CQ.")
-
-    if bitrates:
-        avg_bitrate = round(sum(bitrates) / len(bitrates))
-        return cq, avg_bitrate
-    else:
-        log("⚠️ No valid bitrates found.")
-        return None
+    # Cut each preview window once into a local clip; later rounds and resolutions reuse them
+    try:
+        clips = preview_clips.cut_preview_clips(
+            input_file, [section_seconds(start) for start in start_section], duration
+        )
+    except RuntimeError as e:
+        log(f"⚠️ Could not cut preview clips, encoding from the source instead: {e}")
+        clips = {}
+
+    tasks = [
+        {"input_file": input_file, "res": res, "cq": cq, "approved_crop": approved_crop, "start": start,
+         "clip_file": clips.get(section_seconds(start)), "proxy": proxy, "duration": duration}
+        for cq in cqs for start in start_section
+    ]
+    results = preview_executor.PreviewExecutor(encode_preview_section).run(tasks)
 
+    averages = {}
+    for cq in cqs:
+        measured = [(weights[task["start"]], bitrate) for task, bitrate in zip(tasks, results) if task["cq"] == cq and bitrate]
+        if measured:
+            averages[cq] = round(sum(w * bitrate for w, bitrate in measured) / sum(w for w, _ in measured))
+        else:
+            log(f"⚠️ No valid bitrates found for CQ {cq}.")
+            averages[cq] = None
+    return averages
+
+
+def search_cq(input_file, res, approved_crop, proxy=False, factor=1.0, start_cq=17):
+    """
+    Run the CQ search on preview bitrates (proxy previews scaled by `factor`) and return it.
+    The search fits a bitrate-vs-CQ curve as probes come in and jumps straight to the
+    predicted CQ, so it normally settles in 2-3 preview rounds. Each round encodes
+    `cq_candidates_per_round` CQs around the estimate in parallel.
+    """
+    search = cq_search.CQSearch(BITRATE_RANGES[res], cq_range, start_cq=start_cq, max_probes=cq_search_max_probes)
+
+    cqs = search.next_cqs(cq_candidates_per_round)
+    while cqs:
+        for cq, bitrate in encode_previews(input_file, res, cqs, approved_crop, proxy=proxy).items():
+            if bitrate is not None and proxy:
+                bitrate = round(bitrate * factor)
+            print("CQ is", cq, "Bitrate is ", bitrate)
+            search.record(cq, bitrate)
+            if bitrate is not None:
+                log(f"🔍 {'Calibrated proxy bitrate' if proxy else 'Bitrate'} for {res} preview at CQ {cq}: {bitrate} Kbps")
+        log(f"📈 Model now predicts CQ {search.predict()} for {res}")
+        cqs = search.next_cqs(cq_candidates_per_round)
+    return search
+
+
+def adjust_cq_for_bitrate(input_file, res, approved_crop, start_cq=17):
+    """
+    Search for the CQ that puts the preview bitrate inside BITRATE_RANGES[res], starting at `start_cq`.
 
-def adjust_cq_for_bitrate(input_file, res, approved_crop):
+    With a proxy preset configured the search runs on fast proxy previews, scaled by
+    the placebo/proxy factor learned from earlier jobs at this resolution, and only the
+    chosen CQ is confirmed with full-quality previews. Every confirmation is stored as a
+    new pair; if it misses the window, the search is repeated with this source's own
+    ratio.
+    """
     min_bitrate, max_bitrate = BITRATE_RANGES[res]
-    cq = 17
-    while True:
-        cq, bitrate = encode_preview(input_file, res, cq, approved_crop)
-        print("CQ is", cq, "Bitrate is ", bitrate)
-        if bitrate is None:
+    if not encoders.PROXY_PRESET:
+        search = search_cq(input_file, res, approved_crop, start_cq=start_cq)
+        search.save_history(input_file, res)
+        best_cq = search.result()
+        if best_cq is None:
+            log("⚠️ Failed to encode preview.")
+            return None
+        best_bitrate = next(p["bitrate"] for p in search.history if p["cq"] == best_cq)
+    else:
+        factor = bitrate_cache.proxy_factor(res, encoders.PROXY_PRESET) or 1.0
+        # Full-quality confirmations, kept in a search of their own to pick the best and log them
+        confirmed = cq_search.CQSearch(BITRATE_RANGES[res], cq_range)
+        for _ in range(proxy_confirm_rounds):
+            log(f"⚡ Searching CQ for {res} with {encoders.PROXY_PRESET} proxies (factor {factor:.3f})")
+            cq = search_cq(input_file, res, approved_crop, proxy=True, factor=factor, start_cq=start_cq).result()
+            if cq is None or any(p["cq"] == cq for p in confirmed.history):
+                break
+            bitrate = encode_previews(input_file, res, [cq], approved_crop)[cq]
+            confirmed.record(cq, bitrate)
+            if not bitrate:
+                break
+            log(f"🎯 Full-quality preview for {res} at CQ {cq}: {bitrate} Kbps")
+            # Same sections and CQ, so the proxy previews are already in the bitrate cache
+            proxy_bitrate = encode_previews(input_file, res, [cq], approved_crop, proxy=True)[cq]
+            if proxy_bitrate:
+                bitrate_cache.store_proxy_pair(res, encoders.PROXY_PRESET, cq, proxy_bitrate, bitrate,
+                                               cache.source_fingerprint(input_file))
+                factor = bitrate / proxy_bitrate
+            if confirmed.in_range(bitrate):
+                break
+
+        confirmed.save_history(input_file, res)
+        best_cq = confirmed.result()
+        if best_cq is None:
             log("⚠️ Failed to encode preview.")
             return None
+        best_bitrate = next(p["bitrate"] for p in confirmed.history if p["cq"] == best_cq)
+
+    if min_bitrate <= best_bitrate <= max_bitrate:
+        log(f"✅ Bitrate is in range ({min_bitrate}-{max_bitrate} Kbps) at CQ {best_cq}")
+    else:
+        log(f"⚠️ No probe landed in range ({min_bitrate}-{max_bitrate} Kbps), using closest CQ {best_cq} at {best_bitrate} Kbps")
+    return int(best_cq)
+
+
+def final_rate_control(mode, cq, res):
+    """
+    Rate control of a final encode mode, as encoder backend arguments plus extra x264 options:
+    - "crf":     constant quality at `cq`, checked against the bitrate window afterwards
+    - "crf-vbv": constant quality at `cq` with the VBV capped at the top of the window
+    - "2pass":   two-pass ABR aimed at the middle of the window, no CQ needed
+    """
+    min_bitrate, max_bitrate = BITRATE_RANGES[res]
+    if mode == "2pass":
+        return {"bitrate": (min_bitrate + max_bitrate) // 2}, ""
+    if mode == "crf-vbv":
+        return {"quality": cq}, f":vbv-maxrate={max_bitrate}:vbv-bufsize={max_bitrate * 2}"
+    return {"quality": cq}, ""
+
+
+def final_encopts(mode, res):
+    """x264 options of a final encode, including the rate-control extras of `mode`."""
+    return encoders.X264_ENCOPTS + final_rate_control(mode, None, res)[1]
+
+
+def final_backend(mode):
+    """Encoder backend for the final encode; two-pass always runs on a backend that supports it."""
+    backend = encoders.get_backend(encoders.FINAL_ENCODER)
+    if mode == "2pass" and not backend.supports_two_pass:
+        return encoders.get_backend("handbrake")
+    return backend
 
-        log(f"🔍 Bitrate for {res} preview: {bitrate} Kbps")
-        if min_bitrate <= bitrate <= max_bitrate:
-            log(f"✅ Bitrate is in range ({min_bitrate}-{max_bitrate} Kbps)")
-            return int(cq)
-        elif bitrate > max_bitrate:
-            cq += 1
-        elif bitrate < min_bitrate:
-            cq -= 1
 
-        if cq < int(cq_range[0]) or cq > int(cq_range[1]):
-            log("⚠️ CQ adjustment out of range. Using default CQ 17.")
-            return 17
+def final_encode_command(input_file, output_file, approved_crop, cq, settings, res, mode="crf", threads=None):
+    """Encoder command for a final encode (or one chunk of it)."""
+    rate, _ = final_rate_control(mode, cq, res)
+    return final_backend(mode).command(input_file, output_file, approved_crop, settings["width"],
+                                       encopts=final_encopts(mode, res), threads=threads, **rate)
 
 
-def run_final_encode(input_file, output_file, approved_crop, cq, settings, final_encode_log, res, attempts=1, max_attempts=5):
+def corrected_cq(cq, bitrate, res):
+    """
+    CQ expected to move `bitrate` to the middle of the window, using the same
+    exponential model as the CQ search. Always moves at least one step.
+    """
     min_bitrate, max_bitrate = BITRATE_RANGES[res]
-    send_webhook_message(f"Beginning encode {attempts} with cq {cq}")
-    command = [
-        HANDBRAKE_CLI,
-        "-i", input_file,
-        "-o", output_file,
-        "--crop", approved_crop,
-        "--non-anamorphic",
-        "--encoder", "x264",
-        "-a", "none",  # disable audio
-        "-s", "none",  # disable subtitles
-        "--quality", str(cq),
-        "--width", str(settings["width"]),
-        "--encoder-preset", "placebo",
-        "--encoder-profile", "high",
-        "--encoder-level", "4.1",
-        "--encopts",
-        (
-            "subme=10:deblock=-3,-3:me=umh:merange=32:mbtree=0:"
-            "dct-decimate=0:fast-pskip=0:aq-mode=2:aq-strength=1.0:"
-            "qcomp=0.60:psy-rd=1.1,0.00"
-        )
-    ]
-    log(f"\n🚀 Starting final encode for {res}... at CQ {cq}\n")
+    target = (min_bitrate + max_bitrate) / 2
+    step = round(math.log(target / bitrate) / cq_search.DEFAULT_SLOPE)
+    if step == 0:
+        step = 1 if bitrate > max_bitrate else -1
+    return max(int(cq_range[0]), min(int(cq_range[1]), cq + step))
+
+
+def remote_final_encode(input_file, output_file, approved_crop, cq, settings, final_encode_log, res, mode):
+    """
+    Hand a whole resolution's encode to a remote worker. True/False for success, or
+    None when no worker is available and the encode should run locally.
+    """
+    command = final_encode_command(input_file, output_file, approved_crop, cq, settings, res, mode)
+    try:
+        result = coordinator.run_remote("resolution", final_backend(mode).tool, command[1:], output_file)
+    except coordinator.RemoteUnavailable as e:
+        log(f"⚠️ {e}, encoding {res} locally")
+        return None
     with open(final_encode_log, "w", encoding="utf-8", errors="ignore") as log_file:
-        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                                   text=True, encoding="utf-8", errors="ignore")
-        for line in process.stdout:
-            sub_log(line, end="")
-            log_file.write(line)
-            log_file.flush()
-        process.wait()
+        log_file.write(result["log"] if result else "")
+    if not result:
+        send_webhook_message(f"Remote encode failed for {os.path.basename(output_file)}, aborting")
+    return bool(result)
+
+
+def run_final_encode(input_file, output_file, approved_crop, cq, settings, final_encode_log, res, attempts=1, max_attempts=5, mode="crf", chunks=1, encoded=False):
+    """
+    Encode the video of one resolution and retry with a corrected CQ until its bitrate is in range.
+    With `encoded` the first attempt is already on disk (from the ladder encode) and only checked.
+    """
+    min_bitrate, max_bitrate = BITRATE_RANGES[res]
+    if not encoded:
+        send_webhook_message(f"Beginning encode {attempts} with {'2-pass ABR' if mode == '2pass' else f'cq {cq}'}")
+        log(f"\n🚀 Starting final encode for {res}... ({mode}{'' if mode == '2pass' else f' at CQ {cq}'})\n")
+
+    segments = max(chunks, final_encode_segments)
+    # Hand the whole resolution to a remote worker (None: no worker there, encode locally)
+    remote = None
+    if not encoded and segments <= 1 and coordinator.COORDINATOR_URL:
+        remote = remote_final_encode(input_file, output_file, approved_crop, cq, settings, final_encode_log, res, mode)
+        if remote is False:
+            return False
+    if encoded or remote:
+        pass
+    elif segments > 1:
+        # Split at keyframes and encode the pieces (in parallel when chunked), checkpointing
+        # each finished piece, then join them losslessly
+        def build_command(chunk_file, chunk_output, threads):
+            return final_encode_command(chunk_file, chunk_output, approved_crop, cq, settings, res, mode, threads)
+
+        max_workers = chunked_encode.MAX_PARALLEL_CHUNKS if chunks > 1 else 1
+        if not chunked_encode.encode_chunked(input_file, output_file, build_command, segments, final_encode_log,
+                                             max_workers, tool=final_backend(mode).tool):
+            send_webhook_message(f"Chunked encode failed for {os.path.basename(output_file)}, aborting")
+            return False
+    else:
+        command = final_encode_command(input_file, output_file, approved_crop, cq, settings, res, mode)
+        # Project the final bitrate while encoding so a hopeless CRF run is stopped early
+        duration = frames.probe_duration(input_file)
+        projector = bitrate_projection.BitrateProjector(duration) if mode != "2pass" else None
+        verdict = None
+        with open(final_encode_log, "w", encoding="utf-8", errors="ignore") as log_file:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                       text=True, encoding="utf-8", errors="ignore")
+            for line in process.stdout:
+                sub_log(line, end="")
+                log_file.write(line)
+                log_file.flush()
+
+                percent = final_backend(mode).progress(line, duration) if projector else None
+                if percent and os.path.exists(output_file):
+                    projector.add(percent, os.path.getsize(output_file))
+                    verdict = projector.verdict(min_bitrate, max_bitrate)
+                    if verdict:
+                        process.kill()
+                        break
+            process.wait()
+
+        if verdict:
+            projected, band = projector.projection()
+            new_cq = corrected_cq(cq, projected, res)
+            message = (f"⏹️ Stopped encode attempt #{attempts} for {res} at CQ {cq}: projected "
+                       f"{projected:.0f} ± {band:.0f} Kbps is too {verdict}, restarting at CQ {new_cq}")
+            log(message)
+            send_webhook_message(message)
+            os.remove(output_file)
+            if attempts > max_attempts:
+                send_webhook_message("Failed to get desried final bitrate in 5 attempts aborting")
+                return False
+            return run_final_encode(input_file, output_file, approved_crop, new_cq, settings, final_encode_log, res, attempts=attempts + 1, mode=mode, chunks=chunks)
 
     bitrate = get_bitrate(output_file)
-    send_webhook_message(f"Encoding attempt #{attempts} completed at {bitrate} with cq {cq} ")
+    send_webhook_message(f"Encoding attempt #{attempts} completed at {bitrate} with {'2-pass ABR' if mode == '2pass' else f'cq {cq}'} ")
     print("Final ranges are: ",min_bitrate, bitrate, max_bitrate)
+    if bitrate is None:
+        send_webhook_message("Failed to read the final bitrate, aborting")
+        return False
     if min_bitrate <= bitrate <= max_bitrate:
+        if mode != "2pass":
+            job_history.record(input_file, res, approved_crop, cq, bitrate)
         return True
+    elif mode == "2pass":
+        # 2-pass already aimed at the window; another identical run would land in the same place
+        send_webhook_message(f"2-pass encode landed outside {min_bitrate}-{max_bitrate} Kbps, aborting")
+        return False
     elif attempts > max_attempts:
         send_webhook_message("Failed to get desried final bitrate in 5 attempts aborting")
         return False
-    elif bitrate > max_bitrate:
-        return run_final_encode(input_file, output_file, approved_crop, cq + 1, settings, final_encode_log, res, attempts= attempts+1)
-    elif bitrate < min_bitrate:
-        return run_final_encode(input_file, output_file, approved_crop, cq -1, settings, final_encode_log, res)
-
-# --------------------Phase 2 (Audio)--------------------
-def extract_audio(input_file, res):
-    """
-    Extracts the best available audio track using eac3to:
-    - Prioritizes lossless (DTS-HD MA > TrueHD > LPCM > FLAC)
-    - Falls back to best lossy (highest channel count)
-    Returns path to the extracted audio file (single best track).
-    """
-    global temp_audio, qaac_cmd
-    input_dir = os.path.dirname(input_file)
-    base_name = os.path.splitext(os.path.basename(input_file))[0]
-    parent_dir = os.path.normpath(os.path.join(input_dir, ".."))
-    output_dir = os.path.normpath(os.path.join(parent_dir, res))
-    os.makedirs(output_dir, exist_ok=True)
-
-    lossless_codecs = ["DTS-HD MA", "TrueHD", "LPCM", "FLAC"]
-
-    print(f"🎵 Scanning audio tracks for {base_name}...")
-
-    # Get track list
-    list_cmd = ["eac3to", input_file]
-    result = subprocess.run(list_cmd, capture_output=True, text=True)
-    stdout = result.stdout
-    if result.stderr:
-        print(result.stderr)
-
-    # Match tracks
-    track_lines = re.findall(r"(\d+): (.+?)\s*\n", stdout)
-    if not track_lines:
-        print("⚠️ No audio tracks found!")
-        return []
-
-    # Sort by priority: lossless preferred, fallback to best lossy by channel count
-    def track_priority(line):
-        track_num, desc = line
-        for i, codec in enumerate(lossless_codecs):
-            if codec in desc:
-                return 0, i  # Lossless found, lower index = higher priority
-        match = re.search(r"(\d+\.\d) channels", desc)
-        channels = float(match.group(1)) if match else 0
-        return 1, -channels  # Lossy, prefer more channels
-
-    sorted_tracks = sorted(track_lines, key=track_priority)
-    best_track_num, best_desc = sorted_tracks[0]
-    print(f"🎯 Best track: {best_track_num} - {best_desc}")
-
-    # Extract best track
-    is_lossless = any(codec in best_desc for codec in lossless_codecs)
-    is_surround = any(x in best_desc for x in ["5.1", "7.1"])
-
-    if is_lossless:
-        if is_surround:
-            bitrate = "448" if ("480p" in input_file or "576p" in input_file) else "640"
-            output_file = os.path.normpath(
-                os.path.join(output_dir, f"{base_name}@{res}-{bitrate}.ac3")
-            )
-            extract_cmd = f'eac3to "{input_file}" {best_track_num}:"{output_file}" -{bitrate}'
-        else:
-            temp_audio = os.path.join(output_dir, "temp.aac")
-            output_file = os.path.normpath(os.path.join(output_dir, f"{base_name}@{res}.m4a"))
-            extract_cmd = f'eac3to "{input_file}" {best_track_num}:"{temp_audio}"'
-            qaac_cmd = f'qaac64 -V 127 -i "{temp_audio}" --no-delay -o "{output_file}"'
     else:
-        ext = "ac3" if is_surround else "m4a"
-        output_file = os.path.normpath(os.path.join(output_dir, f"{base_name}@{res}.{ext}"))
-        extract_cmd = f'eac3to "{input_file}" {best_track_num}:"{output_file}"'
-
-    print("🔧 Extracting audio...")
-    result = subprocess.run(extract_cmd, shell=True, capture_output=True, text=True)
-    print(result.stdout)
-    if result.stderr:
-        print("STDERR:", result.stderr)
-        send_webhook_message("❌ Audio extraction failed!")
-        return []
-
-    if is_lossless and not is_surround:
-        print("🎛 Converting with qaac...")
-        result = subprocess.run(qaac_cmd, shell=True, capture_output=True, text=True)
-        print(result.stdout)
-        if result.stderr:
-            print("STDERR:", result.stderr)
-        if os.path.exists(temp_audio):
-            os.remove(temp_audio)
-
-    send_webhook_message(f"✅ Audio extraction complete: {output_file}")
-    return [output_file]
-
-# --------------------Phase 3 (Subtitles)--------------------
-def extract_subtitles(mkv_path):
-    """
-    Extracts subtitle tracks using mkvextract and returns a list of paths to the extracted subtitle files.
-    """
-    input_dir = os.path.dirname(mkv_path)
-    base_name = os.path.splitext(os.path.basename(mkv_path))[0]
-
-    mkv = MKVFile(mkv_path)
-    print("MKV merge output:")
-    print(mkv)
-
-    subtitle_paths = []
-
-    for track in mkv.tracks:
-        print("Found track:", track)
-        if track.track_type == "subtitles":
-            if "PGS" in track._track_codec:
-                out_ext = "sup"
-            elif "SubRip" in track._track_codec or "SRT" in track._track_codec:
-                out_ext = "srt"
-            elif "VobSub" in track._track_codec:
-                out_ext = "idx"
-            else:
-                out_ext = "txt"
-
-            language = track._language if track._language else "unknown"
-            output_file = os.path.join(
-                input_dir,
-                f"{base_name}_subtitle_{track._track_id}_{language}.{out_ext}"
-            )
-
-            cmd = [MKVEXTRACT, "tracks", mkv_path, f"{track._track_id}:{output_file}"]
-            print("Running command:", " ".join(cmd))
-            subprocess.run(cmd)
-            send_webhook_message(f"✅ Extracted subtitle track {track._track_id} for {base_name}")
-
-            subtitle_paths.append(output_file)
-        else:
-            log(f"Unable to extract {track._track_id} with codec {track._track_codec} for {base_name}")
-
-    print("Extraction complete!")
-    return subtitle_paths
-
-
-# --------------------Helper: IMDb Title Lookup--------------------
-
+        return run_final_encode(input_file, output_file, approved_crop, corrected_cq(cq, bitrate, res), settings, final_encode_log, res, attempts=attempts + 1, mode=mode, chunks=chunks)
 
+# --------------------Phase 2 (Audio)--------------------
 def find_movie(filename):
     max_retries = 3
     retry_delay_minutes = 30
@@ -548,26 +689,18 @@ def find_movie(filename):
 
 def detect_languages_ffmpeg(input_file):
     """
-    Detects languages of audio tracks using FFmpeg.
+    Detects languages of audio tracks from the cached ffprobe of the source.
     Returns the most common or first detected language (default: 'eng').
     """
-    cmd = [
-        "ffprobe", "-v", "error",
-        "-show_streams", "-select_streams", "a",
-        "-of", "json", input_file
-    ]
-
-    result = subprocess.run(cmd, capture_output=True, text=True)
-
-    if result.stderr:
-        print("Error:", result.stderr)
+    try:
+        audio_streams = media_probe.streams(input_file, "audio")
+    except RuntimeError as e:
+        print("Error:", e)
         return "eng"  # Default to English if detection fails
 
-    # Parse JSON output
-    data = json.loads(result.stdout)
     audio_languages = []
 
-    for stream in data.get("streams", []):
+    for stream in audio_streams:
         lang = stream.get("tags", {}).get("language", "unknown")
         if lang != "unknown":
             audio_languages.append(lang)
@@ -586,7 +719,8 @@ def multiplex_file(
     source_format,
     encoding_used,
     final_filename,
-    file_title
+    file_title,
+    audio_delay=0  # Milliseconds the audio starts after the video, lost when it was demuxed
 ):
     print(f"""
     Video File       : {video_file}
@@ -598,6 +732,7 @@ def multiplex_file(
     Encoding Used    : {encoding_used}
     Final Filename   : {final_filename}
     File Title       : {file_title}
+    Audio Delay      : {audio_delay} ms
     """)
 
     """
@@ -619,6 +754,7 @@ def multiplex_file(
         cmd.extend([
             "--language", f"0:{language}",
             "--default-track", f"0:{default_audio}",
+            "--sync", f"0:{audio_delay}",
             audio_file
         ])
 
@@ -699,153 +835,308 @@ def extract_mediainfo(source_file):
 
 
 # --------------------Main Encoding Function--------------------
-def encode_file(input_file, resolutions, job_id):
+def final_output_paths(input_file, res):
+    """Output directory, encoded video path and final encode log path for one resolution."""
     filename = os.path.basename(input_file)
-    original_filename = os.path.splitext(os.path.basename(input_file))[0]
-    send_webhook_message(f"Beginning encoding for {filename} @ {resolutions}")
+    parent_dir = os.path.normpath(os.path.join(os.path.dirname(input_file), ".."))
+    output_dir = os.path.normpath(os.path.join(parent_dir, res))
+    output_file = os.path.normpath(os.path.join(output_dir, f"{os.path.splitext(filename)[0]}@{res}.mkv"))
+    return output_dir, output_file, os.path.join(output_dir, "handbrake_encode_log.txt")
 
-    # Extract subtitles & store paths
-    subtitle_files = extract_subtitles(input_file)
-    asubtitle_files = extract_subtitles(input_file)
-    report_progress(filename, 5)
-    for res in resolutions:
-        update_resolution_status(job_id, filename, res, f"Extracted Subtitles", "3")
-        status_callback(filename, res, "Starting...")
-        settings = PRESET_SETTINGS.get(res)
-        metadata = config.parse_video_metadata(input_file, settings)
-        settings["width"] = metadata["width"]
-        settings["height"] = metadata["height"]
-
-        if not settings:
-            log(f"❌ No settings found for {res}, skipping...")
-            status_callback(filename, res, "Skipped (no settings)")
-            continue
-
-        # Extract audio & store paths
-        update_resolution_status(job_id, filename, res, f"Extracting Audio", "5")
-        audio_files = extract_audio(input_file, res)
-        print("Audio extracted")
-        update_resolution_status(job_id, filename, res, f"Extracted Audio", "8")
-        update_resolution_status(job_id, filename, res, f"Getting Cropping values", "9")
-        approved_crop = get_cropping(settings, input_file, f"preview_snapshot_{res}.png", res)
-        if not approved_crop:
-            log("⏩ Skipping final encoding due to lack of crop approval.")
-            status_callback(filename, res, "Skipped (no crop)")
-            continue
-
-        update_resolution_status(job_id, filename, res, f"Cropping values extracted", "15")
-        update_resolution_status(job_id, filename, res, f"Checking for Optimal CQ", "17")
-        cq = adjust_cq_for_bitrate(input_file, res, approved_crop)
+
+def prepare_resolution(input_file, res, job_id, final_encode_mode, known_cqs=None):
+    """
+    Settings, approved crop and CQ for one resolution, or None if it is skipped.
+    The CQ is None for 2-pass, which targets the bitrate window directly. The CQ search
+    starts from the job history's prediction, using CQs already found for other
+    resolutions of this job (`known_cqs`, updated in place).
+    """
+    filename = os.path.basename(input_file)
+    settings = PRESET_SETTINGS.get(res)
+    if not settings:
+        log(f"❌ No settings found for {res}, skipping...")
+        status_callback(filename, res, "Skipped (no settings)")
+        return None
+    metadata = config.parse_video_metadata(input_file, settings)
+    settings["width"] = metadata["width"]
+    settings["height"] = metadata["height"]
+
+    update_resolution_status(job_id, filename, res, f"Getting Cropping values", "9")
+    approved_crop = get_cropping(settings, input_file, f"preview_snapshot_{res}.png", res)
+    if not approved_crop:
+        log("⏩ Skipping final encoding due to lack of crop approval.")
+        status_callback(filename, res, "Skipped (no crop)")
+        return None
+
+    update_resolution_status(job_id, filename, res, f"Cropping values extracted", "15")
+    update_resolution_status(job_id, filename, res, f"Checking for Optimal CQ", "17")
+    if final_encode_mode == "2pass":
+        # 2-pass targets the bitrate window directly, no CQ search needed
+        cq = None
+    else:
+        start_cq = job_history.predict_cq(input_file, res, approved_crop, known_cqs)
+        if start_cq is None:
+            start_cq = 17
+        else:
+            log(f"🔮 Job history predicts CQ {start_cq:.1f} for {res}")
+        cq = adjust_cq_for_bitrate(input_file, res, approved_crop, start_cq=start_cq)
+        if known_cqs is not None:
+            known_cqs[res] = cq
         if cq is None:
             log(f"⏩ Final encoding for {res} was cancelled.")
             status_callback(filename, res, "Cancelled")
-            continue
-        update_resolution_status(job_id, filename, res, f"Found Optimal CQ", "20")
-        send_webhook_message(f"Proceeding to Final Encode for {filename}@{res}")
-        update_resolution_status(job_id, filename, res, f"Proceeding to final encode", "25")
+            return None
+    update_resolution_status(job_id, filename, res, f"Found Optimal CQ", "20")
+    return settings, approved_crop, cq
 
-        parent_dir = os.path.normpath(os.path.join(os.path.dirname(input_file), ".."))
 
-        output_dir = os.path.normpath(os.path.join(parent_dir, res))
+def encode_ladder_outputs(input_file, prepared, final_encode_mode):
+    """
+    Encode every prepared resolution in one pass over the source with ffmpeg/libx264
+    and return the resolutions whose video was written. Resolutions left out (or all
+    of them, if the ladder fails) fall back to their own final encode.
+    """
+    crops = {approved_crop for _, approved_crop, _ in prepared.values()}
+    if len(prepared) < 2 or len(crops) != 1:
+        return set()
+
+    rungs = []
+    for res, (settings, approved_crop, cq) in prepared.items():
+        rungs.append({"output": final_output_paths(input_file, res)[1], "width": settings["width"],
+                      "cq": cq, "encopts": final_encopts(final_encode_mode, res)})
+
+    ladder_log = cache.scratch_path(input_file, "ladder_encode_log.txt")
+    log(f"\n🚀 Encoding {', '.join(prepared)} in one pass at CQs {[rung['cq'] for rung in rungs]}\n")
+    send_webhook_message(f"Beginning single-pass ladder encode for {', '.join(prepared)}")
+    if not ladder_encode.encode_ladder(input_file, crops.pop(), rungs, ladder_log, on_line=lambda line: sub_log(line, end="")):
+        send_webhook_message("Ladder encode failed, encoding each resolution on its own")
+        return set()
+
+    for res in prepared:
+        shutil.copyfile(ladder_log, final_output_paths(input_file, res)[2])
+    return set(prepared)
+
+
+def release_title(input_file):
+    """Official title and year of the film from IMDb, falling back to the file name."""
+    grandparent_dir = os.path.basename(os.path.dirname(os.path.dirname(input_file)))
+    movie_data = find_movie(grandparent_dir)  # or find_movie(output_file)
+    if movie_data:
+        return movie_data['original title'], movie_data.get('year', '0000')
+    # Fallback if IMDb not found
+    return os.path.splitext(os.path.basename(input_file))[0], "0000"
+
+
+def release_names(input_file, res, official_title, official_year):
+    """Final MKV path and file title of one resolution's release."""
+    output_dir = final_output_paths(input_file, res)[0]
+    encoding_used = "x264"  # We used x264 in the HandBrake command
+    final_filename = os.path.join(
+        output_dir,
+        f"{official_title.replace(' ', '.')}."
+        f"{official_year}.{res}.{encoding_source_format}.{encoding_used}-HANDJOB.mkv"
+    )
+    file_title = f"{official_title} [{official_year}] {res} {encoding_source_format} - HJ"
+    return final_filename, file_title
 
-        # Construct the normalized output file path using os.path.join
-        output_file = os.path.normpath(
-            os.path.join(output_dir, f"{os.path.splitext(filename)[0]}@{res}.mkv")
-        )
 
-        final_encode_log = os.path.join(output_dir, "handbrake_encode_log.txt")
-
-        print("Output file path:", output_file)  # Debugging
-        log(f"Output file path: {output_file}")  # Debugging
-
-        # Run HandBrake CLI for final encoding
-
-        output = run_final_encode(input_file, output_file, approved_crop, cq, settings, final_encode_log, res)
-
-        if output:
-            update_resolution_status(job_id, filename, res, f"Final video encoding completed", "75")
-            log(f"\n✅ Successfully encoded: {output_file}\n")
-            completion_bitrate = get_bitrate(output_file)
-
-            status_callback(filename, res, "Completed")
-            update_resolution_status(job_id, filename, res, f"Starting Multiplexing", "76")
-            # ---------------------------
-            # >>> ADD MULTIPLEXING CALL <<<
-            # ---------------------------
-            # 1. Find official IMDb data
-            grandparent_dir = os.path.basename(os.path.dirname(os.path.dirname(input_file)))
-            movie_data = find_movie(grandparent_dir)  # or find_movie(output_file)
-            if movie_data:
-                official_title = movie_data['original title']
-                official_year = movie_data.get('year', '0000')
-            else:
-                # Fallback if IMDb not found
-                official_title = os.path.splitext(filename)[0]
-                official_year = "0000"
-
-            # 2. Construct final output name (Step 13)
-            encoding_used = "x264"  # We used x264 in the HandBrake command
-            global encoding_source_format
-            language = detect_languages_ffmpeg(input_file)         # Adjust or auto-detect
-            final_filename = os.path.join(
-                output_dir,
-                f"{official_title.replace(' ', '.')}."
-                f"{official_year}.{res}.{encoding_source_format}.{encoding_used}-HANDJOB.mkv"
-            )
-
-            # 3. Construct the file title (Step 14)
-            file_title = f"{official_title} [{official_year}] {res} {encoding_source_format} - HJ"
-
-            # 4. Run the multiplex
-            multiplex_file(
-                video_file=output_file,
-                audio_files=audio_files,
-                subtitle_files=subtitle_files,
-                language=language,
-                resolution=res,
-                source_format=encoding_source_format,
-                encoding_used=encoding_used,
-                final_filename=final_filename,
-                file_title=file_title
-            )
-            update_resolution_status(job_id, filename, res, f"Completed Multiplexing", "85")
-            #---------------Screenshots---------------
-            output_dir = os.path.normpath(os.path.join(parent_dir, res))
-            screenshot_output_dir = os.path.join(output_dir, "screenshots")
-            send_webhook_message("Extracting Screenshots for ptp upload")
-            screenshot_bbcodes = config.extract_screenshots(screenshot_output_dir, final_filename)
-            update_resolution_status(job_id, filename, res, f"Extracted Screenshots", "90")
-            send_webhook_message("Creating Approval Document")
-            update_resolution_status(job_id, filename, res, f"Creating Upload Doc", "91")
-            log("Extracting MediaInfo...")
-            mediainfo_text = config.extract_mediainfo(final_filename)
-
-            log("\nSearching PTP...")
-            movie_title = official_title.replace('.', ' ')
-
-            print(f"Sending {movie_title}, {official_year}, {final_filename}, {original_filename}")
-
-            ptp_url = config.get_ptp_permalink(movie_title, official_year, final_filename, original_filename)
-            update_resolution_status(job_id, filename, res, f"Fetching Torrent Details", "95")
-            # Step 4: Get movie sources
-            log("\nGetting torrent sources")
-            ptp_sources = config.find_movie_source_cli(ptp_url)
-
-            # Step 5: Generate approval file
-            log("\nGenerating approval document...")
-            approval_output_dir = os.path.join(output_dir, "approval.txt")
-            upload_output_dir = os.path.join(output_dir, "upload.txt")
-            config.generate_approval_form(ptp_url, mediainfo_text, screenshot_bbcodes, approval_output_dir, final_encode_log)
-            config.generate_upload_form(ptp_url, mediainfo_text, screenshot_bbcodes, ptp_sources, upload_output_dir, movie_title)
-            update_resolution_status(job_id, filename, res, f"Completed", "100")
-            print(f"\nProcess complete! Approval file saved to {APPROVAL_FILENAME}")
-            send_completion_webhook(completion_bitrate, res, input_file)
+def encode_resolution(input_file, res, job_id, preparation, final_encode_mode, encoded=False):
+    """Final video encode of one prepared resolution; returns its bitrate, skips the rest of it on failure."""
+    filename = os.path.basename(input_file)
+    if not preparation:
+        raise stage_scheduler.SkipStage(f"{res} was not prepared")
+    settings, approved_crop, cq = preparation
+    send_webhook_message(f"Proceeding to Final Encode for {filename}@{res}")
+    update_resolution_status(job_id, filename, res, f"Proceeding to final encode", "25")
+
+    output_dir, output_file, final_encode_log = final_output_paths(input_file, res)
+    print("Output file path:", output_file)  # Debugging
+    log(f"Output file path: {output_file}")  # Debugging
+
+    # Run HandBrake CLI for final encoding (or just check the ladder encode's output)
+    output = run_final_encode(input_file, output_file, approved_crop, cq, settings, final_encode_log, res,
+                              mode=final_encode_mode, chunks=final_encode_chunks, encoded=encoded)
+    if not output:
+        log(f"\n❌ Encoding failed for {res}!\n")
+        send_webhook_message(f"Encoding failed for {filename}@{res}")
+        status_callback(filename, res, "Failed")
+        raise stage_scheduler.SkipStage(f"final encode of {res} failed")
+
+    update_resolution_status(job_id, filename, res, f"Final video encoding completed", "75")
+    log(f"\n✅ Successfully encoded: {output_file}\n")
+    status_callback(filename, res, "Completed")
+    return get_bitrate(output_file)
+
+
+def mux_resolution(input_file, res, job_id, audio_files, subtitle_files, title, audio_delay=0):
+    """Multiplex one resolution's video, audio and subtitles into its release MKV; returns its path."""
+    filename = os.path.basename(input_file)
+    update_resolution_status(job_id, filename, res, f"Starting Multiplexing", "76")
+    final_filename, file_title = release_names(input_file, res, *title)
+    language = detect_languages_ffmpeg(input_file)         # Adjust or auto-detect
+    multiplex_file(
+        video_file=final_output_paths(input_file, res)[1],
+        audio_files=audio_files,
+        subtitle_files=subtitle_files,
+        language=language,
+        resolution=res,
+        source_format=encoding_source_format,
+        encoding_used="x264",
+        final_filename=final_filename,
+        file_title=file_title,
+        audio_delay=audio_delay
+    )
+    update_resolution_status(job_id, filename, res, f"Completed Multiplexing", "85")
+    return final_filename
 
 
-        else:
-            log(f"\n❌ Encoding failed for {res}!\n")
-            send_webhook_message(f"Encoding failed for {filename}@{res}")
-            status_callback(filename, res, "Failed")
+def resolution_screenshots(input_file, res, job_id, final_filename):
+    """Screenshots of one release for the PTP upload; returns their BBCodes."""
+    screenshot_output_dir = os.path.join(final_output_paths(input_file, res)[0], "screenshots")
+    send_webhook_message("Extracting Screenshots for ptp upload")
+    index = source_index.load_index(input_file)
+    screenshot_bbcodes = config.extract_screenshots(screenshot_output_dir, final_filename,
+                                                    times=index.screenshot_times() if index else None)
+    update_resolution_status(job_id, os.path.basename(input_file), res, f"Extracted Screenshots", "90")
+    return screenshot_bbcodes
+
+
+def ptp_lookup(input_file, res, title):
+    """PTP permalink of the source torrent and its listed sources for one release."""
+    official_title, official_year = title
+    final_filename = release_names(input_file, res, *title)[0]
+    original_filename = os.path.splitext(os.path.basename(input_file))[0]
+    log("\nSearching PTP...")
+    movie_title = official_title.replace('.', ' ')
+    print(f"Sending {movie_title}, {official_year}, {final_filename}, {original_filename}")
+    ptp_url = config.get_ptp_permalink(movie_title, official_year, final_filename, original_filename)
+    # Step 4: Get movie sources
+    log("\nGetting torrent sources")
+    ptp_sources = config.find_movie_source_cli(ptp_url)
+    return ptp_url, ptp_sources
+
+
+def approval_documents(input_file, res, job_id, title, screenshot_bbcodes, mediainfo_text, ptp, completion_bitrate):
+    """Write one release's approval and upload documents and announce it as done."""
+    filename = os.path.basename(input_file)
+    output_dir, _, final_encode_log = final_output_paths(input_file, res)
+    ptp_url, ptp_sources = ptp
+    movie_title = title[0].replace('.', ' ')
+    send_webhook_message("Creating Approval Document")
+    update_resolution_status(job_id, filename, res, f"Creating Upload Doc", "91")
+    # The PTP lookup ran alongside the encode; report it here so the progress never goes backwards
+    update_resolution_status(job_id, filename, res, f"Fetching Torrent Details", "95")
+    # Step 5: Generate approval file
+    log("\nGenerating approval document...")
+    approval_output_dir = os.path.join(output_dir, "approval.txt")
+    upload_output_dir = os.path.join(output_dir, "upload.txt")
+    config.generate_approval_form(ptp_url, mediainfo_text, screenshot_bbcodes, approval_output_dir, final_encode_log)
+    config.generate_upload_form(ptp_url, mediainfo_text, screenshot_bbcodes, ptp_sources, upload_output_dir, movie_title)
+    update_resolution_status(job_id, filename, res, f"Completed", "100")
+    print(f"\nProcess complete! Approval file saved to {APPROVAL_FILENAME}")
+    send_completion_webhook(completion_bitrate, res, input_file)
+
+
+def encode_file(input_file, resolutions, job_id, final_encode_mode=None):
+    """
+    Run one job as a graph of stages (see stage_scheduler): video work (analysis, CQ
+    searches, encodes) takes the CPU slot in resolution order, while demuxing, audio,
+    IMDb/PTP lookups and each finished resolution's mux, screenshots and documents
+    run alongside it under their own limits.
+    """
+    final_encode_mode = final_encode_mode or FINAL_ENCODE_MODE
+    if final_encode_mode not in FINAL_ENCODE_MODES:
+        raise ValueError(f"Unknown final encode mode: {final_encode_mode}")
+    filename = os.path.basename(input_file)
+    original_filename = os.path.splitext(os.path.basename(input_file))[0]
+    send_webhook_message(f"Beginning encoding for {filename} @ {resolutions}")
+    graph = stage_scheduler.StageGraph()
+
+    # One decode pass over the source that crop detection, screenshots and chunking query later
+    def analyse():
+        if source_index.SOURCE_ANALYSIS:
+            try:
+                source_index.get_index(input_file)
+            except (RuntimeError, OSError, ValueError) as e:
+                log(f"⚠️ Source analysis failed, stages will sample the source themselves: {e}")
+
+    # Demux subtitles and the audio track in one read of the source & store paths
+    def demux_source():
+        demuxed = demux.demux_tracks(input_file)
+        send_webhook_message(f"✅ Extracted {len(demuxed['subtitles'])} subtitle tracks and the audio track for {original_filename}")
+        for res in resolutions:
+            update_resolution_status(job_id, filename, res, f"Extracted Subtitles", "3")
+        return demuxed
+
+    # Every resolution's audio from one decode of the best track
+    def prepare_audio():
+        try:
+            audio_outputs = audio.prepare_audio(input_file, resolutions, graph.result("demux"))
+            send_webhook_message(f"✅ Audio extraction complete for {original_filename}")
+        except RuntimeError as e:
+            log(f"❌ Audio extraction failed: {e}")
+            send_webhook_message("❌ Audio extraction failed!")
+            audio_outputs = {}
+        report_progress(filename, 5)
+        return audio_outputs
+
+    graph.add("analysis", analyse, "cpu")
+    graph.add("demux", demux_source, "io")
+    graph.add("audio", prepare_audio, "io", after=["demux"])
+    graph.add("title", lambda: release_title(input_file), "network")
+
+    # Crop approval and CQ search run one resolution after another, so later ones start
+    # from the CQs already found. Without the ladder each resolution's encode is queued
+    # ahead of the next resolution's preparation.
+    known_cqs = {}
+    ladder = final_encode_ladder and final_encode_mode != "2pass" and len(resolutions) > 1
+
+    def prepare(res):
+        status_callback(filename, res, "Starting...")
+        return prepare_resolution(input_file, res, job_id, final_encode_mode, known_cqs)
+
+    def add_prepare(res, previous):
+        return graph.add(f"prepare:{res}", lambda: prepare(res), "cpu", after=[previous])
+
+    # Ladder mode: settle crop and CQ for every resolution first, then encode them all from one decode
+    previous = "analysis"
+    if ladder:
+        def encode_ladder():
+            prepared = {res: graph.result(f"prepare:{res}") for res in resolutions}
+            return encode_ladder_outputs(input_file, {res: p for res, p in prepared.items() if p}, final_encode_mode)
+
+        for res in resolutions:
+            previous = add_prepare(res, previous)
+        graph.add("ladder", encode_ladder, "cpu", after=[f"prepare:{res}" for res in resolutions])
+
+    for res in resolutions:
+        if not ladder:
+            previous = add_prepare(res, previous)
+        graph.add(f"encode:{res}", lambda res=res: encode_resolution(
+            input_file, res, job_id, graph.result(f"prepare:{res}"), final_encode_mode,
+            encoded=ladder and res in graph.result("ladder")
+        ), "cpu", after=[f"prepare:{res}"] + (["ladder"] if ladder else []))
+        graph.add(f"mux:{res}", lambda res=res: mux_resolution(
+            input_file, res, job_id, graph.result("audio").get(res, []),
+            graph.result("demux")["subtitles"], graph.result("title"), graph.result("demux")["audio_delay"]
+        ), "io", after=[f"encode:{res}", "audio", "title"])
+        graph.add(f"screenshots:{res}", lambda res=res: resolution_screenshots(
+            input_file, res, job_id, graph.result(f"mux:{res}")
+        ), "io", after=[f"mux:{res}"])
+        graph.add(f"mediainfo:{res}", lambda res=res: config.extract_mediainfo(graph.result(f"mux:{res}")),
+                  "io", after=[f"mux:{res}"])
+        graph.add(f"ptp:{res}", lambda res=res: ptp_lookup(input_file, res, graph.result("title")),
+                  "network", after=["title"])
+        graph.add(f"approval:{res}", lambda res=res: approval_documents(
+            input_file, res, job_id, graph.result("title"), graph.result(f"screenshots:{res}"),
+            graph.result(f"mediainfo:{res}"), graph.result(f"ptp:{res}"), graph.result(f"encode:{res}")
+        ), "io", after=[f"screenshots:{res}", f"mediainfo:{res}", f"ptp:{res}", f"encode:{res}"])
+
+    try:
+        graph.run()
+    finally:
+        # Preview clips and other per-source intermediates are only needed while the job runs
+        cache.clear_scratch(input_file)
 
 def determine_encodes(file_path):
     """
@@ -893,9 +1184,9 @@ def report_progress(filename, percent):
     sys.stdout.flush()
     time.sleep(0.5)
 
-def start_encoding(file, job_id=None):
+def start_encoding(file, job_id=None, final_encode_mode=None):
     resolutions = determine_encodes(file)
-    encode_file(file, resolutions, job_id)
+    encode_file(file, resolutions, job_id, final_encode_mode)
     log(f"Encoding completed for {file}")
     try:
         requests.post("http://localhost:3030/api/encode/complete", json={
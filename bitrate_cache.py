@@ -0,0 +1,117 @@
+import os
+import json
+import time
+import sqlite3
+from contextlib import closing
+import cache
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+# ========== CONFIGURATION ==========
+DB_FILE = "preview_bitrates.sqlite"
+
+# Least recently used entries beyond this count are evicted
+MAX_ENTRIES = int(os.getenv("BITRATE_CACHE_MAX_ENTRIES") or 20000)
+
+# Entries not used for this many days are evicted
+MAX_AGE_DAYS = float(os.getenv("BITRATE_CACHE_MAX_AGE_DAYS") or 90)
+
+# Proxy correction factors come from the most recent pairs, and need at least this many
+PROXY_PAIR_WINDOW = 50
+MIN_PROXY_PAIRS = 3
+
+
+# ====================================
+
+def connect():
+    """Open the cache database, creating the table on first use. One connection per call, so it is thread safe."""
+    conn = sqlite3.connect(cache.cache_path(DB_FILE), timeout=30)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS preview_bitrates ("
+        " key TEXT PRIMARY KEY,"
+        " bitrate INTEGER NOT NULL,"
+        " params TEXT,"
+        " created REAL NOT NULL,"
+        " used REAL NOT NULL)"
+    )
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS proxy_pairs ("
+        " res TEXT NOT NULL,"
+        " preset TEXT NOT NULL,"
+        " cq INTEGER NOT NULL,"
+        " proxy_bitrate INTEGER NOT NULL,"
+        " bitrate INTEGER NOT NULL,"
+        " source TEXT,"
+        " created REAL NOT NULL)"
+    )
+    return conn
+
+
+def preview_key(source_file, **params):
+    """
+    Cache key for a preview encode: the source fingerprint plus everything that
+    changes the encoded bytes (section, crop, dimensions, CQ, encoder options...).
+    """
+    return f"{cache.source_fingerprint(source_file)}:{cache.params_key(params)}"
+
+
+def lookup(key):
+    """Return the cached bitrate for `key`, or None if it was never measured."""
+    with closing(connect()) as conn, conn:
+        row = conn.execute("SELECT bitrate FROM preview_bitrates WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        conn.execute("UPDATE preview_bitrates SET used = ? WHERE key = ?", (time.time(), key))
+    return row[0]
+
+
+def store(key, bitrate, params=None):
+    """Remember a measured bitrate and apply the eviction policy."""
+    now = time.time()
+    with closing(connect()) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO preview_bitrates (key, bitrate, params, created, used) VALUES (?, ?, ?, ?, ?)",
+            (key, int(bitrate), json.dumps(params, sort_keys=True), now, now)
+        )
+        evict(conn, now)
+
+
+def evict(conn, now=None):
+    """Drop entries older than MAX_AGE_DAYS, then the least recently used beyond MAX_ENTRIES."""
+    now = now or time.time()
+    conn.execute("DELETE FROM preview_bitrates WHERE used < ?", (now - MAX_AGE_DAYS * 86400,))
+    conn.execute(
+        "DELETE FROM preview_bitrates WHERE key NOT IN "
+        "(SELECT key FROM preview_bitrates ORDER BY used DESC LIMIT ?)",
+        (MAX_ENTRIES,)
+    )
+
+
+def store_proxy_pair(res, preset, cq, proxy_bitrate, bitrate, source=None):
+    """Remember the bitrate of a fast proxy preview next to the full-quality preview of the same sections."""
+    with closing(connect()) as conn, conn:
+        conn.execute(
+            "INSERT INTO proxy_pairs (res, preset, cq, proxy_bitrate, bitrate, source, created) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (res, preset, int(cq), int(proxy_bitrate), int(bitrate), source, time.time())
+        )
+
+
+def proxy_factor(res, preset):
+    """
+    Factor that turns a `preset` proxy preview bitrate into the expected full-quality
+    bitrate at `res`: the median ratio of the most recent stored pairs, or None
+    until there are MIN_PROXY_PAIRS of them.
+    """
+    with closing(connect()) as conn:
+        rows = conn.execute(
+            "SELECT bitrate, proxy_bitrate FROM proxy_pairs WHERE res = ? AND preset = ? AND proxy_bitrate > 0 "
+            "ORDER BY created DESC LIMIT ?",
+            (res, preset, PROXY_PAIR_WINDOW)
+        ).fetchall()
+    if len(rows) < MIN_PROXY_PAIRS:
+        return None
+    ratios = sorted(bitrate / proxy_bitrate for bitrate, proxy_bitrate in rows)
+    middle = len(ratios) // 2
+    return ratios[middle] if len(ratios) % 2 else (ratios[middle - 1] + ratios[middle]) / 2
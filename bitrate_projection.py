@@ -0,0 +1,82 @@
+import re
+import math
+
+
+# ========== CONFIGURATION ==========
+# HandBrake progress line, e.g. "Encoding: task 1 of 1, 12.34 % (45.67 fps, ...)"
+PROGRESS_PATTERN = re.compile(r"Encoding: task (\d+) of (\d+), ([\d.]+) %")
+
+# No verdict before this much of the film (in seconds) has been encoded
+MIN_ENCODED_SECONDS = 600
+
+# Content seconds per interval when measuring how much the bitrate swings
+INTERVAL_SECONDS = 60
+
+# Width of the confidence band in standard deviations
+BAND_SIGMAS = 2.0
+
+
+# ====================================
+
+def parse_progress(line):
+    """Return (task, task_count, percent) from a HandBrake progress line, or None."""
+    match = PROGRESS_PATTERN.search(line)
+    if not match:
+        return None
+    return int(match.group(1)), int(match.group(2)), float(match.group(3))
+
+
+class BitrateProjector:
+    """
+    Projects the final average bitrate of a running encode.
+
+    Samples pair the encoded content time (progress x runtime) with the size of the
+    growing output file. The projection is the average so far; the band comes from
+    how much the bitrate of individual intervals has swung, scaled by the share of
+    the film still to come, so it narrows as the encode progresses.
+    """
+
+    def __init__(self, duration):
+        self.duration = duration
+        self.samples = []
+
+    def add(self, percent, size_bytes):
+        seconds = self.duration * percent / 100
+        if seconds <= 0 or size_bytes <= 0:
+            return
+        if self.samples and seconds - self.samples[-1][0] < INTERVAL_SECONDS:
+            return
+        self.samples.append((seconds, size_bytes))
+
+    def projection(self):
+        """(projected Kbps, band half-width Kbps), or None without enough data."""
+        if len(self.samples) < 3:
+            return None
+        seconds, size = self.samples[-1]
+        if seconds < MIN_ENCODED_SECONDS:
+            return None
+
+        average = size * 8 / seconds / 1000
+        rates = [
+            (b2 - b1) * 8 / (s2 - s1) / 1000
+            for (s1, b1), (s2, b2) in zip(self.samples, self.samples[1:])
+        ]
+        mean_rate = sum(rates) / len(rates)
+        spread = math.sqrt(sum((r - mean_rate) ** 2 for r in rates) / (len(rates) - 1)) if len(rates) > 1 else average
+        remaining = max(0.0, 1 - seconds / self.duration)
+        return average, BAND_SIGMAS * spread * remaining
+
+    def verdict(self, min_bitrate, max_bitrate):
+        """
+        "high" or "low" once the whole confidence band sits outside the window,
+        otherwise None (in range, or not sure yet).
+        """
+        projected = self.projection()
+        if projected is None:
+            return None
+        average, band = projected
+        if average - band > max_bitrate:
+            return "high"
+        if average + band < min_bitrate:
+            return "low"
+        return None
@@ -0,0 +1,129 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from functools import lru_cache
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+# ========== CONFIGURATION ==========
+# Everything derived from a source (crops, probes, bitrates...) is kept here between runs
+CACHE_DIR = os.getenv("ENCODE_CACHE_DIR") or "encode_cache"
+
+# Fast local disk for per-source intermediates (preview clips, demuxed tracks...)
+SCRATCH_DIR = os.getenv("ENCODE_SCRATCH_DIR") or os.path.join(tempfile.gettempdir(), "auto_encoder")
+
+# Bytes hashed from the start and end of a source for its fingerprint
+FINGERPRINT_SAMPLE = 1024 * 1024
+
+
+# ====================================
+
+def cache_path(*parts):
+    """Path inside the cache directory, creating the directory if needed."""
+    path = os.path.join(CACHE_DIR, *parts)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return path
+
+
+@lru_cache(maxsize=64)
+def _fingerprint(path, size, mtime):
+    digest = hashlib.sha1(f"{os.path.basename(path)}:{size}".encode("utf-8"))
+    with open(path, "rb") as f:
+        digest.update(f.read(FINGERPRINT_SAMPLE))
+        if size > FINGERPRINT_SAMPLE:
+            f.seek(max(FINGERPRINT_SAMPLE, size - FINGERPRINT_SAMPLE))
+            digest.update(f.read(FINGERPRINT_SAMPLE))
+    return digest.hexdigest()
+
+
+def source_fingerprint(path):
+    """
+    Identify a source by name, size and a hash of its first and last megabyte.
+    Cheap enough for 40 GB remuxes on a network share, and stable across renames
+    of the parent folders or copies to another drive. The hash is only recomputed
+    when the file's size or mtime changes.
+    """
+    stat = os.stat(path)
+    return _fingerprint(path, stat.st_size, stat.st_mtime_ns)
+
+
+def scratch_dir(source_file, *parts):
+    """Directory inside the source's local scratch directory, created if needed."""
+    path = os.path.join(SCRATCH_DIR, source_fingerprint(source_file)[:16], *parts)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def scratch_path(source_file, *parts):
+    """Path in the source's local scratch directory, creating directories as needed."""
+    return os.path.join(scratch_dir(source_file, *parts[:-1]), parts[-1])
+
+
+def in_scratch(path):
+    """Whether a path lies in the scratch directory, i.e. is a short-lived intermediate."""
+    scratch = os.path.abspath(SCRATCH_DIR)
+    return os.path.commonpath([scratch, os.path.abspath(path)]) == scratch
+
+
+def clear_scratch(source_file):
+    """Remove every intermediate kept in the source's scratch directory."""
+    shutil.rmtree(os.path.join(SCRATCH_DIR, source_fingerprint(source_file)[:16]), ignore_errors=True)
+
+
+def params_key(params):
+    """Short stable hash of a dict of parameters, for keying results that depend on them."""
+    encoded = json.dumps(params, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha1(encoded).hexdigest()[:12]
+
+
+def load_json(path, default=None):
+    """Read a JSON cache file, returning `default` if it is missing or unreadable."""
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return default
+
+
+def save_json(path, data):
+    """
+    Write a JSON cache file atomically so concurrent jobs never see half a file,
+    and flush it so it survives a crash or power loss.
+    """
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def evict_files(subdir, max_entries, max_age_days, now=None):
+    """
+    Drop files of a cache subdirectory not used for `max_age_days`, then the least
+    recently used beyond `max_entries`. A file's mtime records when it was last used.
+    """
+    now = now or time.time()
+    directory = os.path.join(CACHE_DIR, subdir)
+    if not os.path.isdir(directory):
+        return
+    entries = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            entries.append((os.path.getmtime(path), path))
+        except OSError:
+            continue  # removed by another job meanwhile
+    entries.sort(reverse=True)
+    for index, (used, path) in enumerate(entries):
+        if index >= max_entries or used < now - max_age_days * 86400:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
@@ -0,0 +1,250 @@
+import os
+import glob
+import shutil
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+import cache
+import frames
+import preview_executor
+import coordinator
+import source_index
+
+
+load_dotenv()
+
+# ========== CONFIGURATION ==========
+MKVMERGE = os.getenv("MKVMERGE") or "mkvmerge"
+
+# Most chunk encodes allowed to run at the same time
+MAX_PARALLEL_CHUNKS = int(os.getenv("MAX_PARALLEL_CHUNKS") or 4)
+
+# x264 threads of every segment encode, local or remote (0 = this machine's cores split between
+# the parallel chunks). Fixed per job and recorded in the checkpoint, since x264's output
+# depends on its thread count
+SEGMENT_THREADS = int(os.getenv("SEGMENT_THREADS") or 0)
+
+
+# ====================================
+
+def keyframe_times(input_file):
+    """Timestamps (seconds) of every video keyframe, read from packet flags without decoding."""
+    cmd = [
+        frames.FFPROBE, "-v", "error", "-select_streams", "v:0",
+        "-show_entries", "packet=pts_time,flags",
+        "-of", "csv=p=0", input_file
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    times = []
+    for line in result.stdout.splitlines():
+        pts_time, _, flags = line.partition(",")
+        if "K" in flags and pts_time not in ("", "N/A"):
+            times.append(float(pts_time))
+    return sorted(times)
+
+
+def split_points(cut_times, duration, chunks):
+    """
+    Pick `chunks - 1` split points from candidate cut times (keyframes or scene cuts),
+    each the candidate nearest to an even division of the runtime.
+    """
+    candidates = [t for t in cut_times if 0 < t < duration]
+    points = []
+    for i in range(1, chunks):
+        target = duration * i / chunks
+        if candidates:
+            nearest = min(candidates, key=lambda t: abs(t - target))
+            if nearest not in points:
+                points.append(nearest)
+    return sorted(points)
+
+
+def split_source(input_file, points, chunk_dir):
+    """
+    Stream-copy the video of the source into chunks at the given split points.
+    The segment muxer only cuts on keyframes, so each chunk starts with one and
+    no frame is lost or duplicated. A finished split is reused, so every resolution
+    encodes from the same local chunks. Returns the chunk paths in order.
+    """
+    done_marker = os.path.join(chunk_dir, "split.done")
+    if os.path.exists(done_marker):
+        return sorted(glob.glob(os.path.join(chunk_dir, "source_*.mkv")))
+
+    for old_chunk in glob.glob(os.path.join(chunk_dir, "source_*.mkv")):
+        os.remove(old_chunk)
+
+    cmd = [
+        frames.FFMPEG, "-v", "error", "-y", "-i", input_file,
+        "-map", "0:v:0", "-c", "copy",
+        "-f", "segment", "-reset_timestamps", "1",
+    ]
+    if points:
+        cmd += ["-segment_times", ",".join(f"{p:.3f}" for p in points)]
+    cmd.append(os.path.join(chunk_dir, "source_%04d.mkv"))
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to split {input_file} into chunks: {result.stderr.strip()}")
+
+    open(done_marker, "w").close()
+    return sorted(glob.glob(os.path.join(chunk_dir, "source_*.mkv")))
+
+
+def count_frames(path):
+    """Number of video frames in a file, counted from packets (demux only, no decode)."""
+    cmd = [
+        frames.FFPROBE, "-v", "error", "-select_streams", "v:0", "-count_packets",
+        "-show_entries", "stream=nb_read_packets",
+        "-of", "csv=p=0", path
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    return int(result.stdout.strip().rstrip(","))
+
+
+def concat_chunks(chunk_files, output_file, seed=None):
+    """
+    Losslessly append encoded chunks into one MKV with mkvmerge.
+    With a `seed` mkvmerge writes deterministic UIDs and dates, so joining the same
+    chunks always gives a bit-identical file.
+    """
+    cmd = [MKVMERGE, "-o", output_file]
+    if seed is not None:
+        cmd += ["--deterministic", str(seed)]
+    cmd.append(chunk_files[0])
+    for chunk_file in chunk_files[1:]:
+        cmd += ["+", chunk_file]
+    result = subprocess.run(cmd, capture_output=True, text=True, encoding="utf-8", errors="ignore")
+    # mkvmerge exits with 1 for warnings, 2 for errors
+    if result.returncode > 1:
+        raise RuntimeError(f"mkvmerge failed to join chunks: {result.stdout.strip()}")
+
+
+def sync_file(path):
+    """Flush a finished file to disk before it is recorded as a checkpoint."""
+    with open(path, "rb") as f:
+        os.fsync(f.fileno())
+
+
+def encode_chunk(command, log_path, output_file, tool="handbrake"):
+    """
+    Run one chunk encode, writing its output to its own log. Returns True on success.
+    With a coordinator configured the chunk goes to a remote worker, which runs its own `tool`.
+    """
+    if coordinator.scratch_coordinator():
+        try:
+            result = coordinator.run_remote("chunk", tool, command[1:], output_file)
+            with open(log_path, "w", encoding="utf-8", errors="ignore") as log_file:
+                log_file.write(result["log"] if result else "")
+            return bool(result)
+        except coordinator.RemoteUnavailable as e:
+            print(f"⚠️ {e}, encoding the chunk locally")
+
+    with open(log_path, "w", encoding="utf-8", errors="ignore") as log_file:
+        process = subprocess.Popen(command, stdout=log_file, stderr=subprocess.STDOUT)
+        return process.wait() == 0
+
+
+def checkpoint_dir_for(output_file):
+    """Durable checkpoint directory kept next to the final output."""
+    stem = os.path.splitext(os.path.basename(output_file))[0]
+    return os.path.join(os.path.dirname(output_file), f".{stem}.segments")
+
+
+def encode_chunked(input_file, output_file, build_command, chunks, final_encode_log, max_workers=MAX_PARALLEL_CHUNKS,
+                   tool="handbrake"):
+    """
+    Encode a title as `chunks` segments and join them into `output_file`.
+
+    The source is split at keyframes close to even divisions of the runtime, every
+    segment is encoded by the command `build_command(chunk, output, threads)` returns,
+    the results are appended losslessly and the frame count of the output is checked
+    against the source chunks. Chunk logs are combined into `final_encode_log`.
+
+    Progress is checkpointed next to the output: finished segments and a manifest
+    of split points, thread count, settings and completed segments. Every segment,
+    local or remote, is encoded with the same pinned thread count. A stopped or
+    crashed job resumes from the completed segments, and because the split, the
+    x264 settings and the mkvmerge seed are all recorded, the joined file is
+    bit-identical to an uninterrupted run; with another thread count it starts over.
+    Returns True if the output has every frame.
+    """
+    checkpoint_dir = checkpoint_dir_for(output_file)
+    os.makedirs(checkpoint_dir, exist_ok=True)
+    manifest_file = os.path.join(checkpoint_dir, "manifest.json")
+    manifest = cache.load_json(manifest_file, {})
+    fingerprint = cache.source_fingerprint(input_file)
+    threads = SEGMENT_THREADS or preview_executor.thread_budget(max(1, min(max_workers, chunks)))
+
+    if manifest.get("source") == fingerprint and manifest.get("segments") and manifest.get("threads") != threads:
+        print(f"⚠️ Checkpoint was encoded with {manifest.get('threads')} threads, not {threads}: starting over")
+    if manifest.get("source") != fingerprint or manifest.get("chunks") != chunks or manifest.get("threads") != threads:
+        duration = frames.probe_duration(input_file)
+        index = source_index.load_index(input_file)
+        cut_times = index.keyframe_times() if index else keyframe_times(input_file)
+        points = split_points(cut_times, duration, chunks)
+        manifest = {"source": fingerprint, "chunks": chunks, "points": points, "threads": threads,
+                    "settings": None, "segments": {}}
+    else:
+        print(f"♻️ Resuming from checkpoint with {len(manifest['segments'])} finished segments")
+
+    # Segments encoded with other settings (e.g. a new CQ) cannot be reused
+    settings = cache.params_key({"command": build_command("<chunk>", "<output>", manifest["threads"])[1:]})
+    if manifest["settings"] != settings:
+        manifest.update(settings=settings, segments={})
+    cache.save_json(manifest_file, manifest)
+
+    chunk_dir = cache.scratch_dir(input_file, "chunks", cache.params_key(manifest["points"]))
+    print(f"✂️ Using {len(manifest['points']) + 1} chunks split at {manifest['points']}")
+    source_chunks = split_source(input_file, manifest["points"], chunk_dir)
+
+    names = [os.path.splitext(os.path.basename(chunk).replace("source_", ""))[0] for chunk in source_chunks]
+    encoded_chunks = [os.path.join(checkpoint_dir, f"segment_{name}.mkv") for name in names]
+    log_paths = [os.path.join(checkpoint_dir, f"log_{name}.txt") for name in names]
+
+    def finished(name, encoded):
+        segment = manifest["segments"].get(name)
+        return bool(segment) and os.path.exists(encoded) and os.path.getsize(encoded) == segment["size"]
+
+    pending = [i for i, (name, encoded) in enumerate(zip(names, encoded_chunks)) if not finished(name, encoded)]
+    manifest_lock = threading.Lock()
+
+    def encode_segment(index):
+        ok = encode_chunk(build_command(source_chunks[index], encoded_chunks[index], manifest["threads"]),
+                          log_paths[index], encoded_chunks[index], tool)
+        if ok:
+            sync_file(encoded_chunks[index])
+            with manifest_lock:
+                manifest["segments"][names[index]] = {
+                    "size": os.path.getsize(encoded_chunks[index]),
+                    "frames": count_frames(encoded_chunks[index]),
+                }
+                cache.save_json(manifest_file, manifest)
+        return ok
+
+    workers = len(pending) if coordinator.scratch_coordinator() else max(1, min(max_workers, len(pending)))
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = list(pool.map(encode_segment, pending))
+
+    with open(final_encode_log, "w", encoding="utf-8", errors="ignore") as log_file:
+        for index, log_path in enumerate(log_paths):
+            log_file.write(f"===== Chunk {index + 1}/{len(log_paths)} =====\n")
+            if os.path.exists(log_path):
+                with open(log_path, "r", encoding="utf-8", errors="ignore") as chunk_log:
+                    log_file.write(chunk_log.read())
+
+    if not all(results):
+        failed = [pending[i] + 1 for i, ok in enumerate(results) if not ok]
+        print(f"❌ Chunk encodes failed: {failed}")
+        return False
+
+    concat_chunks(encoded_chunks, output_file, seed=settings)
+
+    source_frames = sum(count_frames(chunk) for chunk in source_chunks)
+    output_frames = count_frames(output_file)
+    if source_frames != output_frames:
+        print(f"❌ Frame count mismatch: source chunks have {source_frames}, output has {output_frames}")
+        return False
+
+    print(f"✅ Joined {len(encoded_chunks)} chunks, {output_frames} frames")
+    shutil.rmtree(checkpoint_dir, ignore_errors=True)
+    return True
@@ -0,0 +1,130 @@
+import os
+import sys
+import time
+import socket
+import logging
+import argparse
+import tempfile
+import threading
+import subprocess
+from flask import Flask
+from werkzeug.serving import make_server
+import coordinator
+
+
+# ========== CONFIGURATION ==========
+# Short timings so a lost worker is noticed within seconds
+HEARTBEAT_TIMEOUT = 2
+WORKER_HEARTBEAT_INTERVAL = 0.3
+POLL_INTERVAL = 0.2
+
+# How long the fake encode runs, and how long the whole check may take
+TASK_SECONDS = 4
+CHECK_TIMEOUT = 60
+
+
+# ====================================
+
+# Stands in for an encoder: takes a while, then writes the output file
+FAKE_ENCODE = "import sys, time; time.sleep(float(sys.argv[1])); open(sys.argv[2], 'w').write('encoded')"
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_coordinator(port):
+    """Serve a fresh task board with short heartbeat timeouts from a background thread."""
+    coordinator.board = coordinator.TaskBoard(heartbeat_timeout=HEARTBEAT_TIMEOUT)
+    coordinator.POLL_INTERVAL = POLL_INTERVAL
+    app = Flask(__name__)
+    app.register_blueprint(coordinator.blueprint)
+    logging.getLogger("werkzeug").setLevel(logging.ERROR)
+    server = make_server("127.0.0.1", port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_workers(url, count):
+    """Launch `count` worker.py processes whose "handbrake" is this Python interpreter."""
+    env = dict(os.environ, HANDBRAKE_CLI=sys.executable, FFPROBE="ffprobe-not-needed",
+               WORKER_HEARTBEAT_INTERVAL=str(WORKER_HEARTBEAT_INTERVAL), WORKER_POLL_INTERVAL=str(POLL_INTERVAL))
+    worker_script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "worker.py")
+    return {
+        f"check-{i}": subprocess.Popen([sys.executable, worker_script, url, "--name", f"check-{i}"], env=env,
+                                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        for i in range(count)
+    }
+
+
+def running_worker(task_id):
+    """Name of the worker currently running the task, or None."""
+    board = coordinator.board
+    with board.lock:
+        task = board.tasks.get(task_id)
+        if not task or task["status"] != "running":
+            return None
+        worker = board.workers.get(task["worker"])
+        return worker["name"] if worker else None
+
+
+def wait_for(condition, timeout):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        value = condition()
+        if value:
+            return value
+        time.sleep(0.1)
+    raise AssertionError("Timed out waiting for the cluster")
+
+
+def run_check(workers):
+    """
+    Start a coordinator and `workers` local worker processes, submit one task with
+    run_remote, kill the worker running it halfway and check that another worker
+    finishes it.
+    """
+    port = free_port()
+    url = f"http://127.0.0.1:{port}"
+    server = start_coordinator(port)
+    processes = start_workers(url, workers)
+    try:
+        with tempfile.TemporaryDirectory() as scratch:
+            output = os.path.join(scratch, "chunk.mkv")
+            outcome = {}
+            client = threading.Thread(target=lambda: outcome.update(result=coordinator.run_remote(
+                "chunk", "handbrake", ["-c", FAKE_ENCODE, str(TASK_SECONDS), output], output, url
+            )), daemon=True)
+            client.start()
+
+            task_id = wait_for(lambda: next(iter(coordinator.board.tasks), None), CHECK_TIMEOUT)
+            first = wait_for(lambda: running_worker(task_id), CHECK_TIMEOUT)
+            time.sleep(TASK_SECONDS / 2)
+            print(f"🔪 Killing {first} halfway through task {task_id}")
+            processes[first].kill()
+
+            second = wait_for(lambda: running_worker(task_id) not in (None, first) and running_worker(task_id),
+                              CHECK_TIMEOUT)
+            print(f"🔁 Task {task_id} reassigned to {second}")
+            client.join(CHECK_TIMEOUT)
+
+            task = coordinator.board.status(task_id)
+            assert outcome.get("result") and outcome["result"]["ok"], f"Task did not succeed: {outcome}"
+            assert task["attempts"] == 2, f"Expected 2 attempts, got {task['attempts']}"
+            assert os.path.exists(output), "The reassigned worker wrote no output"
+        print(f"✅ Task survived losing {first} and was finished by {second}")
+    finally:
+        for process in processes.values():
+            process.kill()
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    # Check the coordinator/worker mode on one machine, e.g. `python cluster_check.py --workers 3`
+    parser = argparse.ArgumentParser(description="Check that a task lost with its worker is reassigned")
+    parser.add_argument("--workers", type=int, default=3)
+    args = parser.parse_args()
+    sys.stdout.reconfigure(encoding='utf-8')
+    run_check(max(2, args.workers))
@@ -8,6 +8,7 @@ import re
 from moviepy import VideoFileClip
 from ptpapi import API, login as ptp_login
 from flask.cli import load_dotenv
+import media_probe
 
 
 load_dotenv()
@@ -47,23 +48,13 @@ def extract_mediainfo(source_file):
 
 def parse_video_metadata(source_file_path, settings):
     """Extract metadata and adjust target height based on aspect ratio."""
-    mediainfo_text = extract_mediainfo(source_file_path)
+    stream = media_probe.video_stream(source_file_path)
 
-    metadata = {}
-
-    # Raw metadata extraction
-    width_match = re.search(r"Width\s+:\s+(\d+)\s+pixels", mediainfo_text)
-    height_match = re.search(r"Height\s+:\s+(\d+)\s+pixels", mediainfo_text)
-    aspect_ratio_match = re.search(r"Display aspect ratio\s+:\s+([\d.]+:\d+)", mediainfo_text)
-
-    if width_match:
-        metadata['source_width'] = int(width_match.group(1))
-    if height_match:
-        metadata['source_height'] = int(height_match.group(1))
-    if aspect_ratio_match:
-        metadata['aspect_ratio'] = aspect_ratio_match.group(1)
-    else:
-        raise ValueError("Aspect ratio not found in metadata.")
+    metadata = {
+        'source_width': int(stream["width"]),
+        'source_height': int(stream["height"]),
+        'aspect_ratio': f"{media_probe.display_aspect_ratio(stream):.4f}:1",
+    }
 
     # Target width from preset
     target_width = settings["width"]
@@ -108,19 +99,27 @@ def upload_to_ptpimg(file_path):
     return None
 
 
-def extract_screenshots(SCREENSHOT_OUTPUT_DIR, SOURCE_FILE_PATH):
-    """Extract and upload screenshots (skipping first 5 minutes)"""
+def extract_screenshots(SCREENSHOT_OUTPUT_DIR, SOURCE_FILE_PATH, times=None):
+    """
+    Extract and upload screenshots (skipping first 5 minutes)
+    With `times` (e.g. picked from the source analysis index) those frames are saved
+    directly instead of sampling the file for well-lit ones.
+    """
     clip = VideoFileClip(SOURCE_FILE_PATH)
     duration = clip.duration
     screenshot_data = []
+    os.makedirs(SCREENSHOT_OUTPUT_DIR, exist_ok=True)
+
+    for i, t in enumerate(times or []):
+        out_path = os.path.join(SCREENSHOT_OUTPUT_DIR, f"screenshot_{i+1}.png")
+        clip.save_frame(out_path, t=min(t, duration))
+        screenshot_data.append(out_path)
 
     # Skip first 300 seconds (5 minutes)
     start_offset = 300 if duration > 300 else 0
     usable_duration = duration - start_offset
 
-    os.makedirs(SCREENSHOT_OUTPUT_DIR, exist_ok=True)
-
-    for i in range(3):
+    for i in range(0 if times else 3):
         best_time = None
         best_score = -1
 
@@ -0,0 +1,338 @@
+import os
+import time
+import uuid
+import threading
+from collections import deque
+import requests
+from flask import Blueprint, Flask, request, jsonify
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+# ========== CONFIGURATION ==========
+# When set, encode commands are handed to remote workers through this coordinator
+COORDINATOR_URL = os.getenv("ENCODE_COORDINATOR_URL")
+
+# Workers silent for longer than this are considered lost and their tasks re-queued
+HEARTBEAT_TIMEOUT = float(os.getenv("ENCODE_HEARTBEAT_TIMEOUT") or 60)
+
+# A task is given up after failing on this many workers
+MAX_TASK_ATTEMPTS = 3
+
+# Finished tasks are forgotten this long after they ended
+TASK_RETENTION = 600
+
+# Seconds between status polls while waiting for remote tasks
+POLL_INTERVAL = float(os.getenv("ENCODE_POLL_INTERVAL") or 5)
+
+# A remote task is run locally instead once no worker has been alive (or the coordinator
+# reachable) for this long
+REMOTE_TIMEOUT = float(os.getenv("REMOTE_TIMEOUT") or 300)
+
+# Preview and chunk tasks read and write the scratch directory, so workers can only take
+# them when it is set explicitly (to a share every worker reaches)
+SHARED_SCRATCH = bool(os.getenv("ENCODE_SCRATCH_DIR"))
+
+
+# ====================================
+
+class TaskBoard:
+    """
+    In-memory queue of encode tasks shared by the coordinator and its workers.
+
+    Workers register, pull tasks, send heartbeats while they work and report the
+    result. Each pull hands out a lease, and results are accepted for the lease, so a
+    worker that re-registers mid-task (and gets a new worker id) can still report it.
+    Tasks held by a worker whose heartbeat stops are put back on the queue for someone
+    else; lost workers are detected lazily on every pull or status call.
+    """
+
+    def __init__(self, heartbeat_timeout=HEARTBEAT_TIMEOUT, max_attempts=MAX_TASK_ATTEMPTS):
+        self.heartbeat_timeout = heartbeat_timeout
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.queue = deque()
+        self.workers = {}
+
+    def register(self, name, cores, lease=None):
+        """Add a worker; one re-registering while it runs a task passes that task's lease to keep it."""
+        worker_id = uuid.uuid4().hex[:12]
+        with self.lock:
+            self.workers[worker_id] = {"name": name, "cores": cores, "last_seen": time.time(), "task": None}
+            task = self.leased(lease)
+            if task:
+                self.release(task["worker"])
+                task["worker"] = worker_id
+                self.workers[worker_id]["task"] = task["id"]
+        return worker_id
+
+    def leased(self, lease):
+        """The running task handed out under `lease`, if it still is (call with the lock held)."""
+        if not lease:
+            return None
+        return next((task for task in self.tasks.values() if task["lease"] == lease and task["status"] == "running"), None)
+
+    def heartbeat(self, worker_id):
+        with self.lock:
+            worker = self.workers.get(worker_id)
+            if worker is None:
+                return False
+            worker["last_seen"] = time.time()
+            return True
+
+    def submit(self, kind, payload):
+        task_id = uuid.uuid4().hex[:12]
+        with self.lock:
+            self.tasks[task_id] = {
+                "id": task_id, "kind": kind, "payload": payload, "status": "queued",
+                "worker": None, "lease": None, "attempts": 0, "result": None, "error": None,
+                "finished": None,
+            }
+            self.queue.append(task_id)
+        return task_id
+
+    def pull(self, worker_id, kinds=None):
+        """Hand the next queued task (optionally limited to `kinds`) to a worker; KeyError for unknown workers."""
+        self.reap()
+        with self.lock:
+            worker = self.workers.get(worker_id)
+            if worker is None:
+                raise KeyError(worker_id)
+            worker["last_seen"] = time.time()
+            for task_id in list(self.queue):
+                task = self.tasks[task_id]
+                if kinds and task["kind"] not in kinds:
+                    continue
+                self.queue.remove(task_id)
+                task.update(status="running", worker=worker_id, lease=uuid.uuid4().hex, attempts=task["attempts"] + 1)
+                worker["task"] = task_id
+                return dict(task)
+        return None
+
+    def complete(self, task_id, lease, result):
+        with self.lock:
+            task = self.leased(lease)
+            if task is None or task["id"] != task_id:
+                return False
+            self.release(task["worker"])
+            task.update(status="done", result=result, worker=None, lease=None, finished=time.time())
+            return True
+
+    def fail(self, task_id, lease, error):
+        with self.lock:
+            task = self.leased(lease)
+            if task is None or task["id"] != task_id:
+                return False
+            self.release(task["worker"])
+            self.requeue(task, error)
+            return True
+
+    def cancel(self, task_id):
+        """Withdraw a task nobody has started yet; False once a worker runs it."""
+        with self.lock:
+            task = self.tasks.get(task_id)
+            if task is None or task["status"] != "queued":
+                return False
+            self.queue.remove(task_id)
+            task.update(status="cancelled", finished=time.time())
+            return True
+
+    def release(self, worker_id):
+        worker = self.workers.get(worker_id)
+        if worker:
+            worker["task"] = None
+            worker["last_seen"] = time.time()
+
+    def requeue(self, task, error):
+        task.update(worker=None, lease=None, error=error)
+        if task["attempts"] >= self.max_attempts:
+            task.update(status="failed", finished=time.time())
+        else:
+            task["status"] = "queued"
+            self.queue.appendleft(task["id"])
+
+    def reap(self):
+        """
+        Drop workers that stopped sending heartbeats and re-queue the task each one held,
+        and forget finished tasks their submitter had TASK_RETENTION seconds to collect.
+        """
+        now = time.time()
+        cutoff = now - self.heartbeat_timeout
+        with self.lock:
+            for task_id, task in list(self.tasks.items()):
+                if task["finished"] and task["finished"] < now - TASK_RETENTION:
+                    del self.tasks[task_id]
+            for worker_id, worker in list(self.workers.items()):
+                if worker["last_seen"] >= cutoff:
+                    continue
+                task = self.tasks.get(worker["task"])
+                if task and task["status"] == "running" and task["worker"] == worker_id:
+                    self.requeue(task, f"worker {worker['name']} lost")
+                del self.workers[worker_id]
+
+    def status(self, task_id):
+        """A copy of the task plus the number of live workers, or None for an unknown task."""
+        self.reap()
+        with self.lock:
+            task = self.tasks.get(task_id)
+            return dict(task, live_workers=len(self.workers)) if task else None
+
+
+board = TaskBoard()
+blueprint = Blueprint("cluster", __name__, url_prefix="/cluster")
+
+
+@blueprint.route("/workers", methods=["POST"])
+def register_worker():
+    data = request.get_json() or {}
+    worker_id = board.register(data.get("name", "worker"), data.get("cores"), data.get("lease"))
+    return jsonify({"worker_id": worker_id, "heartbeat_timeout": board.heartbeat_timeout}), 200
+
+
+@blueprint.route("/workers/<worker_id>/heartbeat", methods=["POST"])
+def worker_heartbeat(worker_id):
+    if board.heartbeat(worker_id):
+        return jsonify({"status": "ok"}), 200
+    return jsonify({"error": "Unknown worker, register again"}), 404
+
+
+@blueprint.route("/tasks", methods=["POST"])
+def submit_task():
+    data = request.get_json() or {}
+    if not data.get("kind") or not data.get("payload"):
+        return jsonify({"error": "Missing kind or payload"}), 400
+    return jsonify({"task_id": board.submit(data["kind"], data["payload"])}), 200
+
+
+@blueprint.route("/tasks/pull", methods=["POST"])
+def pull_task():
+    data = request.get_json() or {}
+    try:
+        task = board.pull(data.get("worker_id"), data.get("kinds"))
+    except KeyError:
+        return jsonify({"error": "Unknown worker, register again"}), 404
+    if task is None:
+        return "", 204
+    return jsonify(task), 200
+
+
+@blueprint.route("/tasks/<task_id>", methods=["GET"])
+def task_status(task_id):
+    task = board.status(task_id)
+    if task is None:
+        return jsonify({"error": "Task not found"}), 404
+    return jsonify(task), 200
+
+
+@blueprint.route("/tasks/<task_id>", methods=["DELETE"])
+def cancel_task(task_id):
+    if board.cancel(task_id):
+        return jsonify({"status": "ok"}), 200
+    return jsonify({"error": "Task is not queued"}), 409
+
+
+@blueprint.route("/tasks/<task_id>/complete", methods=["POST"])
+def complete_task(task_id):
+    data = request.get_json() or {}
+    if board.complete(task_id, data.get("lease"), data.get("result")):
+        return jsonify({"status": "ok"}), 200
+    return jsonify({"error": "Lease expired, the task was handed to another worker"}), 409
+
+
+@blueprint.route("/tasks/<task_id>/fail", methods=["POST"])
+def fail_task(task_id):
+    data = request.get_json() or {}
+    if board.fail(task_id, data.get("lease"), data.get("error")):
+        return jsonify({"status": "ok"}), 200
+    return jsonify({"error": "Lease expired, the task was handed to another worker"}), 409
+
+
+# --------------------Client helpers--------------------
+
+class RemoteUnavailable(RuntimeError):
+    """No worker was alive to run a remote task; the caller runs it locally instead."""
+
+
+_scratch_warned = False
+
+
+def scratch_coordinator():
+    """
+    Coordinator to send tasks working in the scratch directory (previews, chunks) to,
+    or None to encode them locally. Without an explicit ENCODE_SCRATCH_DIR the scratch
+    directory is a local temp folder workers cannot reach, so every such task would
+    fail on all its attempts; that is reported once instead.
+    """
+    global _scratch_warned
+    if COORDINATOR_URL and not SHARED_SCRATCH:
+        if not _scratch_warned:
+            _scratch_warned = True
+            print("⚠️ ENCODE_COORDINATOR_URL is set but ENCODE_SCRATCH_DIR is not: workers cannot reach "
+                  "the local scratch directory, so previews and chunks are encoded locally")
+        return None
+    return COORDINATOR_URL
+
+
+def submit_remote(url, kind, payload):
+    response = requests.post(f"{url}/cluster/tasks", json={"kind": kind, "payload": payload})
+    response.raise_for_status()
+    return response.json()["task_id"]
+
+
+def run_remote(kind, tool, args, output, coordinator_url=None):
+    """
+    Run one encoder command on a remote worker and wait for its result.
+    `tool` names the executable ("handbrake", "ffmpeg", ...) so each worker can use
+    its own install path, and `output` must be on storage every worker can reach.
+    Returns the worker's result dict ({"ok", "bitrate", "frames", "log"}) or None
+    if the task failed on every attempt. A task the coordinator forgot (it restarted)
+    is submitted again. Raises RemoteUnavailable once no worker has been alive, or the
+    coordinator reachable, for REMOTE_TIMEOUT seconds.
+    """
+    url = (coordinator_url or COORDINATOR_URL).rstrip("/")
+    payload = {"tool": tool, "args": args, "output": output}
+    try:
+        task_id = submit_remote(url, kind, payload)
+    except requests.RequestException as e:
+        raise RemoteUnavailable(f"Coordinator unreachable: {e}") from e
+
+    alive = time.time()
+    while True:
+        if time.time() - alive > REMOTE_TIMEOUT:
+            try:
+                if requests.delete(f"{url}/cluster/tasks/{task_id}").status_code == 409:
+                    # A worker picked it up in the meantime
+                    alive = time.time()
+                    continue
+            except requests.RequestException:
+                pass
+            raise RemoteUnavailable(f"No worker ran {kind} task {task_id} within {REMOTE_TIMEOUT:.0f} seconds")
+
+        time.sleep(POLL_INTERVAL)
+        try:
+            response = requests.get(f"{url}/cluster/tasks/{task_id}")
+            if response.status_code == 404:
+                print(f"⚠️ Coordinator lost {kind} task {task_id}, submitting it again")
+                task_id = submit_remote(url, kind, payload)
+                continue
+            response.raise_for_status()
+        except requests.RequestException as e:
+            print(f"⚠️ Coordinator unreachable, retrying: {e}")
+            continue
+        task = response.json()
+        if task["status"] == "running" or task["live_workers"]:
+            alive = time.time()
+        if task["status"] == "done":
+            return task["result"]
+        if task["status"] == "failed":
+            print(f"❌ Remote {kind} task {task_id} failed: {task['error']}")
+            return None
+
+
+if __name__ == "__main__":
+    # Standalone coordinator, e.g. for testing workers without the encode server
+    app = Flask(__name__)
+    app.register_blueprint(blueprint)
+    app.run(host="0.0.0.0", port=5002, threaded=True)
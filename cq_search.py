@@ -0,0 +1,193 @@
+import math
+import json
+import time
+import cache
+
+
+# ========== CONFIGURATION ==========
+# x264 CRF roughly halves the bitrate every 6 steps; used until two probes exist
+DEFAULT_SLOPE = -math.log(2) / 6
+
+# Fitted slopes are clamped to this range so one noisy probe cannot derail the model
+SLOPE_LIMITS = (-0.4, -0.03)
+
+# Probe history is appended here (one JSON object per search) for later analysis
+HISTORY_FILE = "cq_search_history.jsonl"
+
+
+# ====================================
+
+class CQSearch:
+    """
+    Finds a CQ whose preview bitrate lands inside a target window.
+
+    Bitrate is modelled as exponential in CQ (log-bitrate linear in CQ). Every probe
+    refits the model and the next CQ is the one predicted to hit the middle of the
+    window. Probes that bracket the answer are remembered, and if the model predicts
+    outside that bracket (or a CQ already tried) the search bisects instead.
+
+        search = CQSearch((5000, 7000), (9, 27), start_cq=17)
+        cq = search.next_cq()
+        while cq is not None:
+            search.record(cq, encode_and_measure(cq))
+            cq = search.next_cq()
+        best_cq = search.result()
+    """
+
+    def __init__(self, bitrate_range, cq_range, start_cq=17, max_probes=3):
+        """`max_probes` is the number of probe rounds; a round may test several CQs at once."""
+        self.min_bitrate, self.max_bitrate = bitrate_range
+        self.min_cq, self.max_cq = int(cq_range[0]), int(cq_range[1])
+        self.target = (self.min_bitrate + self.max_bitrate) / 2
+        self.start_cq = self.clamp(start_cq)
+        self.max_probes = max_probes
+        self.history = []
+        self.rounds = 0
+        self.pending = {}
+
+    def clamp(self, cq):
+        return max(self.min_cq, min(self.max_cq, int(round(cq))))
+
+    def in_range(self, bitrate):
+        return self.min_bitrate <= bitrate <= self.max_bitrate
+
+    def record(self, cq, bitrate):
+        """Store the measured bitrate for a probed CQ."""
+        self.history.append({
+            "cq": cq,
+            "bitrate": bitrate,
+            "round": self.rounds,
+            "reason": self.pending.pop(cq, "manual"),
+            "predicted_cq": self.predict(),
+        })
+
+    def fit(self):
+        """Return (intercept, slope) of log(bitrate) = intercept + slope * cq."""
+        points = [(p["cq"], math.log(p["bitrate"])) for p in self.history if p["bitrate"]]
+        if not points:
+            return None
+
+        slope = DEFAULT_SLOPE
+        cqs = {cq for cq, _ in points}
+        if len(cqs) > 1:
+            mean_cq = sum(cq for cq, _ in points) / len(points)
+            mean_log = sum(value for _, value in points) / len(points)
+            covariance = sum((cq - mean_cq) * (value - mean_log) for cq, value in points)
+            variance = sum((cq - mean_cq) ** 2 for cq, _ in points)
+            slope = min(SLOPE_LIMITS[1], max(SLOPE_LIMITS[0], covariance / variance))
+
+        # Anchor the line on the most recent probe, it is closest to the answer
+        last_cq, last_log = points[-1]
+        return last_log - slope * last_cq, slope
+
+    def predict(self):
+        """CQ the model expects to hit the middle of the bitrate window, or None without data."""
+        model = self.fit()
+        if model is None:
+            return None
+        intercept, slope = model
+        return round((math.log(self.target) - intercept) / slope, 2)
+
+    def bracket(self):
+        """
+        Open interval (low, high) of CQs that can still be the answer.
+        A CQ whose bitrate was too high pushes `low` up, one that was too low pushes `high` down.
+        """
+        low, high = self.min_cq - 1, self.max_cq + 1
+        for probe in self.history:
+            if probe["bitrate"] is None:
+                continue
+            if probe["bitrate"] > self.max_bitrate:
+                low = max(low, probe["cq"])
+            elif probe["bitrate"] < self.min_bitrate:
+                high = min(high, probe["cq"])
+        return low, high
+
+    def done(self):
+        if any(p["bitrate"] and self.in_range(p["bitrate"]) for p in self.history):
+            return True
+        if self.rounds >= self.max_probes:
+            return True
+        low, high = self.bracket()
+        return high - low <= 1
+
+    def choose(self):
+        """Pick the next CQ and the reason for it, or (None, None) if nothing is left to try."""
+        if not self.history:
+            return self.start_cq, "start"
+        if self.done():
+            return None, None
+
+        low, high = self.bracket()
+        tried = {p["cq"] for p in self.history}
+        predicted = self.predict()
+        if predicted is not None:
+            cq = self.clamp(predicted)
+            if low < cq < high and cq not in tried:
+                return cq, "model"
+
+        cq = self.clamp((max(low, self.min_cq) + min(high, self.max_cq)) / 2)
+        if low < cq < high and cq not in tried:
+            return cq, "bisect"
+        untried = [c for c in range(low + 1, high) if c not in tried and self.min_cq <= c <= self.max_cq]
+        return (untried[0], "bisect") if untried else (None, None)
+
+    def next_cqs(self, count=1):
+        """
+        CQs to probe in the next round: the model's pick first, then untried neighbours
+        inside the bracket, nearest first. Empty once the search has converged or run
+        out of rounds. Probing several at once lets the caller encode them in parallel.
+        """
+        first, reason = self.choose()
+        if first is None:
+            return []
+
+        low, high = self.bracket()
+        tried = {p["cq"] for p in self.history}
+        candidates = [first]
+        self.pending[first] = reason
+        offset = 1
+        while len(candidates) < count and offset <= self.max_cq - self.min_cq:
+            for cq in (first - offset, first + offset):
+                if len(candidates) < count and low < cq < high and self.min_cq <= cq <= self.max_cq and cq not in tried:
+                    candidates.append(cq)
+                    self.pending[cq] = "neighbour"
+            offset += 1
+
+        self.rounds += 1
+        return candidates
+
+    def next_cq(self):
+        """Next CQ to probe, or None once the search has converged or run out of probes."""
+        candidates = self.next_cqs(1)
+        return candidates[0] if candidates else None
+
+    def result(self):
+        """
+        Best CQ found: the probe inside the window closest to its middle, otherwise the
+        probe whose bitrate came closest to the window. None if nothing was measured.
+        """
+        measured = [p for p in self.history if p["bitrate"]]
+        if not measured:
+            return None
+
+        def distance(probe):
+            bitrate = probe["bitrate"]
+            if self.in_range(bitrate):
+                return 0, abs(bitrate - self.target)
+            return 1, min(abs(bitrate - self.min_bitrate), abs(bitrate - self.max_bitrate))
+
+        return min(measured, key=distance)["cq"]
+
+    def save_history(self, source, res):
+        """Append this search's probes to the history log in the cache directory."""
+        entry = {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "source": source,
+            "res": res,
+            "bitrate_range": [self.min_bitrate, self.max_bitrate],
+            "probes": self.history,
+            "result": self.result(),
+        }
+        with open(cache.cache_path(HISTORY_FILE), "a", encoding="utf-8") as f:
+            f.write(json.dumps(entry) + "\n")
@@ -0,0 +1,115 @@
+import numpy as np
+
+
+# ========== CONFIGURATION ==========
+# Luma at or below this counts as black (limited-range black sits at 16)
+BLACK_THRESHOLD = 24
+
+# A row/column is picture content once this fraction of its pixels is brighter than black,
+# so small logos or burned-in text inside the bars do not count as picture
+MIN_CONTENT_FRACTION = 0.05
+
+# Frames whose edge differs from the vote by more than this many pixels are outliers
+OUTLIER_TOLERANCE = 4
+
+# Frames processed per vectorized chunk, bounds the size of the temporary masks
+CHUNK_FRAMES = 16
+
+
+# ====================================
+
+def make_even(values):
+    """Round crop values up to the next even number (x264 needs mod-2 dimensions)."""
+    return values + (values & 1)
+
+
+def detector_params():
+    """The settings a detection result depends on, used to key cached crops."""
+    return {
+        "threshold": BLACK_THRESHOLD,
+        "min_fraction": MIN_CONTENT_FRACTION,
+        "tolerance": OUTLIER_TOLERANCE,
+    }
+
+
+def content_profiles(stack, threshold=BLACK_THRESHOLD):
+    """
+    Compute per-row and per-column content fractions for a stack of gray frames.
+    `stack` is (N, height, width) uint8; returns (N, height) and (N, width) float arrays.
+    """
+    count, height, width = stack.shape
+    rows = np.empty((count, height), dtype=np.float32)
+    cols = np.empty((count, width), dtype=np.float32)
+    for start in range(0, count, CHUNK_FRAMES):
+        bright = stack[start:start + CHUNK_FRAMES] > threshold
+        rows[start:start + CHUNK_FRAMES] = bright.mean(axis=2)
+        cols[start:start + CHUNK_FRAMES] = bright.mean(axis=1)
+    return rows, cols
+
+
+def edge_distances(profile, min_fraction=MIN_CONTENT_FRACTION):
+    """
+    Distance from each edge to the first content line for every frame in a profile.
+    Returns (leading, trailing, valid) where `valid` is False for frames with no content.
+    """
+    content = profile >= min_fraction
+    valid = content.any(axis=1)
+    length = profile.shape[1]
+    leading = content.argmax(axis=1)
+    trailing = content[:, ::-1].argmax(axis=1)
+    leading[~valid] = length
+    trailing[~valid] = length
+    return leading, trailing, valid
+
+
+def vote_edge(values, tolerance=OUTLIER_TOLERANCE):
+    """
+    Vote a single crop edge across frames.
+    The most common (even) value wins; values further than `tolerance` from it are
+    rejected as outliers (dark scenes, fades, logos) and the smallest inlier is kept
+    so picture is never cropped away. Returns (crop, number of agreeing frames).
+    """
+    even = make_even(values)
+    winner = np.bincount(even).argmax()
+    inliers = even[np.abs(even - winner) <= tolerance]
+    return int(inliers.min()), len(inliers)
+
+
+def detect_crop(stack, threshold=BLACK_THRESHOLD, min_fraction=MIN_CONTENT_FRACTION, tolerance=OUTLIER_TOLERANCE):
+    """
+    Detect black bars across a stack of N gray frames with temporal voting.
+    Returns a dict with the crop as (top, bottom, left, right), a confidence between
+    0 and 1 (share of sampled frames agreeing on the weakest edge) and the number of
+    frames that had any picture content.
+    """
+    return detect_crop_from_profiles(*content_profiles(stack, threshold), min_fraction, tolerance)
+
+
+def detect_crop_from_profiles(rows, cols, min_fraction=MIN_CONTENT_FRACTION, tolerance=OUTLIER_TOLERANCE):
+    """detect_crop on precomputed (N, height) and (N, width) content profiles."""
+    top, bottom, rows_valid = edge_distances(rows, min_fraction)
+    left, right, cols_valid = edge_distances(cols, min_fraction)
+    valid = rows_valid & cols_valid
+
+    if not valid.any():
+        return {"crop": (0, 0, 0, 0), "confidence": 0.0, "frames": 0}
+
+    crop = []
+    agreeing = []
+    for values in (top, bottom, left, right):
+        edge, votes = vote_edge(values[valid], tolerance)
+        crop.append(edge)
+        agreeing.append(votes)
+
+    return {
+        "crop": tuple(crop),
+        "confidence": round(min(agreeing) / len(rows), 3),
+        "frames": int(valid.sum()),
+    }
+
+
+def best_lit_frame(stack, step=8):
+    """Index of the frame with the highest brightness plus contrast, measured on a subsampled grid."""
+    sample = stack[:, ::step, ::step].astype(np.float32)
+    scores = sample.mean(axis=(1, 2)) + sample.std(axis=(1, 2))
+    return int(scores.argmax())
@@ -0,0 +1,86 @@
+import os
+import subprocess
+from dotenv import load_dotenv
+import cache
+import media_probe
+
+
+load_dotenv()
+
+# ========== CONFIGURATION ==========
+MKVEXTRACT = os.getenv("MKVEXTRACT") or "mkvextract"
+
+# Lossless audio in order of preference; otherwise the lossy track with the most channels wins
+LOSSLESS_CODECS = ["DTS-HD MA", "TrueHD", "LPCM", "FLAC"]
+
+# File extension of each elementary stream mkvextract writes, by ffprobe codec name
+EXTENSIONS = {
+    "dts": "dts", "truehd": "thd", "flac": "flac", "ac3": "ac3", "eac3": "eac3", "aac": "aac",
+    "hdmv_pgs_subtitle": "sup", "subrip": "srt", "dvd_subtitle": "idx", "ass": "ass",
+}
+
+
+# ====================================
+
+def best_audio_stream(input_file):
+    """The audio stream to deliver: best lossless track, else the lossy one with most channels. None without audio."""
+    def priority(stream):
+        codec = media_probe.audio_codec(stream)
+        if codec in LOSSLESS_CODECS:
+            return 0, LOSSLESS_CODECS.index(codec)
+        return 1, -int(stream.get("channels") or 0)
+
+    audio = media_probe.streams(input_file, "audio")
+    return min(audio, key=priority) if audio else None
+
+
+def extension(stream):
+    codec = stream.get("codec_name") or ""
+    if codec.startswith("pcm_"):
+        return "wav"
+    return EXTENSIONS.get(codec, "txt" if stream.get("codec_type") == "subtitle" else "bin")
+
+
+def demux_tracks(input_file):
+    """
+    Extract every subtitle track and the best audio track with a single mkvextract
+    run, i.e. one read of the source, into the job's scratch space.
+
+    Returns {"audio": path or None, "audio_stream": probe stream or None,
+    "audio_delay": ms, "subtitles": [paths]}. The raw audio stream loses the track's
+    start offset in the container, so "audio_delay" carries it to the mux.
+    Subtitles are named `<name>_subtitle_<id>_<lang>.<ext>` so the muxer can read
+    their language back. A finished demux is reused.
+    """
+    base_name = os.path.splitext(os.path.basename(input_file))[0]
+    done_marker = cache.scratch_path(input_file, "demux", "demux.json")
+    done = cache.load_json(done_marker, None)
+    if done and "audio_delay" in done and all(os.path.exists(path) for path in done["subtitles"] + [p for p in [done["audio"]] if p]):
+        print("♻️ Reusing demuxed tracks")
+        return done
+
+    audio_stream = best_audio_stream(input_file)
+    targets = []
+    subtitles = []
+    for stream in media_probe.streams(input_file, "subtitle"):
+        language = stream.get("tags", {}).get("language") or "unknown"
+        path = cache.scratch_path(input_file, "demux", f"{base_name}_subtitle_{stream['index']}_{language}.{extension(stream)}")
+        targets.append(f"{stream['index']}:{path}")
+        subtitles.append(path)
+    audio = None
+    audio_delay = 0
+    if audio_stream:
+        audio_delay = media_probe.start_delay_ms(input_file, audio_stream)
+        audio = cache.scratch_path(input_file, "demux", f"{base_name}_audio_{audio_stream['index']}.{extension(audio_stream)}")
+        targets.append(f"{audio_stream['index']}:{audio}")
+
+    result = {"audio": audio, "audio_stream": audio_stream, "audio_delay": audio_delay, "subtitles": subtitles}
+    if targets:
+        cmd = [MKVEXTRACT, "tracks", input_file, *targets]
+        print("Running command:", " ".join(cmd))
+        process = subprocess.run(cmd, capture_output=True, text=True, encoding="utf-8", errors="ignore")
+        # mkvextract exits with 1 for warnings, 2 for errors
+        if process.returncode > 1:
+            raise RuntimeError(f"mkvextract failed: {process.stdout.strip()}")
+    cache.save_json(done_marker, result)
+    return result
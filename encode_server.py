@@ -1,5 +1,6 @@
 from flask import Flask, request, jsonify
-from auto_encoder import start_encoding
+from auto_encoder import start_encoding, FINAL_ENCODE_MODES
+import coordinator
 from multiprocessing import Process
 import os
 import json
@@ -10,6 +11,8 @@ import requests
 from datetime import datetime
 
 app = Flask(__name__)
+# Coordinator endpoints for remote encode workers (see worker.py)
+app.register_blueprint(coordinator.blueprint)
 
 job_id = None
 filename = None
@@ -184,10 +187,14 @@ def start_encode():
 
     job_id = data.get('jobid')
     filename = data.get('filename')
+    final_encode_mode = data.get('final_encode_mode')
 
     if not job_id or not filename:
         return jsonify({'error': 'Missing job_id or filename'}), 400
 
+    if final_encode_mode and final_encode_mode not in FINAL_ENCODE_MODES:
+        return jsonify({'error': f'Unknown final_encode_mode, expected one of {list(FINAL_ENCODE_MODES)}'}), 400
+
     print(f"Received job_id: {job_id}, filename: {filename}")
     
     # Import the determine_encodes function
@@ -211,19 +218,19 @@ def start_encode():
     ensure_log_directory()
     
     # Create a new process with output redirection
-    p = Process(target=run_encoding_with_logging, args=(filename, job_id))
+    p = Process(target=run_encoding_with_logging, args=(filename, job_id, final_encode_mode))
     p.start()
     job_store[job_id] = p
 
     return jsonify({'status': 'started', 'job_id': job_id, 'filename': filename}), 200
 
-def run_encoding_with_logging(filename, job_id):
+def run_encoding_with_logging(filename, job_id, final_encode_mode=None):
     """Run the encoding process with logging"""
     try:
         # Redirect output to log file
         redirect_output_to_file(job_id)
         # Run the encoding
-        start_encoding(filename, job_id)
+        start_encoding(filename, job_id, final_encode_mode)
     finally:
         # Restore stdout/stderr
         sys.stdout = sys.__stdout__
@@ -0,0 +1,180 @@
+import os
+import re
+from abc import ABC, abstractmethod
+from dotenv import load_dotenv
+import bitrate_projection
+
+
+load_dotenv()
+
+# ========== CONFIGURATION ==========
+HANDBRAKE_CLI = os.getenv("HANDBRAKE_CLI") or "HandBrakeCLI"
+FFMPEG = os.getenv("FFMPEG") or "ffmpeg"
+
+# x264 settings shared by every preview and final encode, whatever runs them
+X264_PRESET = "placebo"
+X264_PROFILE = "high"
+X264_LEVEL = "4.1"
+X264_ENCOPTS = (
+    "subme=10:deblock=-3,-3:me=umh:merange=32:mbtree=0:"
+    "dct-decimate=0:fast-pskip=0:aq-mode=2:aq-strength=1.0:"
+    "qcomp=0.60:psy-rd=1.1,0.00"
+)
+
+# Proxy previews: a fast preset without the expensive motion search options, keeping the
+# options that shape the bitrate. Unset = every preview runs the full settings.
+PROXY_PRESET = os.getenv("PREVIEW_PROXY_PRESET") or None
+PROXY_ENCOPTS = (
+    "deblock=-3,-3:mbtree=0:dct-decimate=0:fast-pskip=0:"
+    "aq-mode=2:aq-strength=1.0:qcomp=0.60:psy-rd=1.1,0.00"
+)
+
+# Backend used by each stage ("handbrake" or "ffmpeg")
+PREVIEW_ENCODER = os.getenv("PREVIEW_ENCODER") or "handbrake"
+FINAL_ENCODER = os.getenv("FINAL_ENCODER") or "handbrake"
+
+# Scaler used by the ffmpeg backend
+SCALE_FLAGS = "lanczos+accurate_rnd+full_chroma_int"
+
+
+# ====================================
+
+def crop_filter(crop):
+    """ffmpeg crop filter for a HandBrake "top:bottom:left:right" crop string."""
+    top, bottom, left, right = (int(v) for v in crop.split(":"))
+    return f"crop=iw-{left + right}:ih-{top + bottom}:{left}:{top}"
+
+
+def scale_filter(width, height=None):
+    """
+    ffmpeg scale filter to `width`, keeping the aspect ratio. A `height` only bounds
+    the output, as it does for HandBrake, so the same settings give both backends
+    the same geometry.
+    """
+    if height:
+        return (f"scale={width}:{height}:flags={SCALE_FLAGS}:force_original_aspect_ratio=decrease:"
+                f"force_divisible_by=2,setsar=1")
+    return f"scale={width}:-2:flags={SCALE_FLAGS},setsar=1"
+
+
+class EncoderBackend(ABC):
+    """
+    Builds the command for one video-only x264 encode from encoder-neutral settings:
+    crop ("top:bottom:left:right"), output size, constant quality or a two-pass
+    bitrate, x264 preset/options, thread count and an optional section of the input.
+    `tool` names the executable for remote workers.
+    """
+
+    name = None
+    tool = None
+    supports_two_pass = False
+
+    @abstractmethod
+    def command(self, input_file, output_file, crop, width, height=None, quality=None, bitrate=None,
+                preset=X264_PRESET, encopts=X264_ENCOPTS, threads=None, start=None, duration=None):
+        """The encoder's argv, executable first."""
+
+    def progress(self, line, duration):
+        """Percent done parsed from one line of encoder output, or None."""
+        return None
+
+
+class HandBrakeBackend(EncoderBackend):
+    """HandBrakeCLI. Rescans the title on every launch and seeks coarsely, but does two-pass in one run."""
+
+    name = "handbrake"
+    tool = "handbrake"
+    supports_two_pass = True
+
+    def command(self, input_file, output_file, crop, width, height=None, quality=None, bitrate=None,
+                preset=X264_PRESET, encopts=X264_ENCOPTS, threads=None, start=None, duration=None):
+        if threads:
+            encopts += f":threads={threads}"
+        cmd = [
+            HANDBRAKE_CLI,
+            "-i", input_file,
+            "-o", output_file,
+            "--crop", crop,
+            "--non-anamorphic",
+            "--encoder", "x264",
+            "-a", "none",  # disable audio
+            "-s", "none",  # disable subtitles
+        ]
+        if bitrate:
+            cmd += ["--vb", str(bitrate), "--two-pass", "--turbo"]
+        else:
+            cmd += ["--quality", str(quality)]
+        cmd += ["--width", str(width)]
+        if height:
+            cmd += ["--height", str(height)]
+        cmd += [
+            "--encoder-preset", preset,
+            "--encoder-profile", X264_PROFILE,
+            "--encoder-level", X264_LEVEL,
+            "--encopts", encopts,
+        ]
+        if start is not None:
+            cmd += ["--start-at", f"seconds:{start}"]
+        if duration is not None:
+            cmd += ["--stop-at", f"seconds:{duration}"]
+        return cmd
+
+    def progress(self, line, duration):
+        parsed = bitrate_projection.parse_progress(line)
+        return parsed[2] if parsed else None
+
+
+class FFmpegBackend(EncoderBackend):
+    """ffmpeg with libx264. No title scan and frame-accurate seeking; no single-command two-pass."""
+
+    name = "ffmpeg"
+    tool = "ffmpeg"
+    TIME_PATTERN = re.compile(r"time=(\d+):(\d+):([\d.]+)")
+
+    def command(self, input_file, output_file, crop, width, height=None, quality=None, bitrate=None,
+                preset=X264_PRESET, encopts=X264_ENCOPTS, threads=None, start=None, duration=None):
+        if bitrate:
+            raise ValueError("The ffmpeg backend does not do two-pass encodes")
+        if threads:
+            encopts += f":threads={threads}"
+        cmd = [FFMPEG, "-hide_banner", "-y"]
+        if start is not None:
+            cmd += ["-ss", str(start)]
+        cmd += ["-i", input_file]
+        if duration is not None:
+            cmd += ["-t", str(duration)]
+        cmd += ["-map", "0:v:0", "-vf", f"{crop_filter(crop)},{scale_filter(width, height)}"]
+        cmd += x264_output_args(quality, preset, encopts)
+        cmd.append(output_file)
+        return cmd
+
+    def progress(self, line, duration):
+        match = self.TIME_PATTERN.search(line)
+        if not match or not duration:
+            return None
+        hours, minutes, seconds = match.groups()
+        return min(100.0, (int(hours) * 3600 + int(minutes) * 60 + float(seconds)) / duration * 100)
+
+
+def x264_output_args(quality, preset=X264_PRESET, encopts=X264_ENCOPTS):
+    """ffmpeg output options for a video-only libx264 encode with the shared x264 settings."""
+    return [
+        "-c:v", "libx264",
+        "-preset", preset,
+        "-profile:v", X264_PROFILE,
+        "-level:v", X264_LEVEL,
+        "-pix_fmt", "yuv420p",
+        "-crf", str(quality),
+        "-x264-params", encopts,
+        "-an", "-sn", "-dn", "-map_chapters", "-1",
+    ]
+
+
+BACKENDS = {backend.name: backend for backend in (HandBrakeBackend(), FFmpegBackend())}
+
+
+def get_backend(name):
+    """Backend registered under `name`."""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown encoder backend: {name}")
+    return BACKENDS[name]
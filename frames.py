@@ -0,0 +1,158 @@
+import os
+import subprocess
+import numpy as np
+from dotenv import load_dotenv
+import media_probe
+
+
+load_dotenv()
+
+# ========== CONFIGURATION ==========
+FFMPEG = os.getenv("FFMPEG") or "ffmpeg"
+FFPROBE = os.getenv("FFPROBE") or "ffprobe"
+
+# Most inputs a single seeking ffmpeg process is given at once
+MAX_SEEK_INPUTS = 32
+
+# Seconds read after each input-side seek; only the first frame is kept
+SEEK_WINDOW = 2
+
+# Raw pixel formats we know how to lay out in a NumPy buffer
+PIX_FMT_CHANNELS = {
+    "gray": 1,
+    "bgr24": 3,
+}
+
+
+# ====================================
+
+def probe_video_size(input_file):
+    """Return (width, height) of the first video stream, from the cached ffprobe."""
+    stream = media_probe.video_stream(input_file)
+    return int(stream["width"]), int(stream["height"])
+
+
+def probe_duration(input_file):
+    """Return the container duration in seconds, from the cached ffprobe."""
+    return media_probe.duration(input_file)
+
+
+def sample_timestamps(duration, count, margin=0.05):
+    """`count` evenly spaced timestamps, skipping `margin` of the runtime at each end."""
+    start, end = duration * margin, duration * (1 - margin)
+    step = (end - start) / count
+    return [round(start + step * (i + 0.5), 3) for i in range(count)]
+
+
+def read_exact(stream, out):
+    """
+    Fill the NumPy array `out` with bytes from a binary stream.
+    Returns False if the stream ended before the array was full.
+    """
+    view = memoryview(out).cast("B")
+    filled = 0
+    while filled < len(view):
+        count = stream.readinto(view[filled:])
+        if not count:
+            return False
+        filled += count
+    return True
+
+
+def seek_input_args(input_file, start_time, exact=False, window=SEEK_WINDOW):
+    """
+    Input arguments that seek before opening the source.
+    ffmpeg jumps to the keyframe before `start_time` instead of decoding from
+    the beginning. With `exact` the frames between that keyframe and
+    `start_time` are decoded and dropped so the first frame lands on the
+    requested timestamp; without it the keyframe itself is returned and
+    non-keyframes are never decoded.
+    """
+    args = ["-ss", str(start_time)]
+    if not exact:
+        args += ["-noaccurate_seek", "-skip_frame", "nokey"]
+    if window:
+        args += ["-t", str(window)]
+    return args + ["-i", input_file]
+
+
+class FrameReader:
+    """
+    Grabs decoded frames from ffmpeg as raw video over a pipe, straight into a
+    reusable NumPy buffer. Nothing is written to disk and no image codec is involved.
+    """
+
+    def __init__(self, input_file, pix_fmt="gray", size=None):
+        if pix_fmt not in PIX_FMT_CHANNELS:
+            raise ValueError(f"Unsupported pixel format: {pix_fmt}")
+        self.input_file = input_file
+        self.pix_fmt = pix_fmt
+        self.width, self.height = size or probe_video_size(input_file)
+        self.channels = PIX_FMT_CHANNELS[pix_fmt]
+        self.buffer = np.empty(self.shape, dtype=np.uint8)
+
+    @property
+    def shape(self):
+        if self.channels == 1:
+            return self.height, self.width
+        return self.height, self.width, self.channels
+
+    def raw_args(self):
+        """Output arguments that make ffmpeg write raw frames to stdout."""
+        return ["-an", "-sn", "-dn", "-f", "rawvideo", "-pix_fmt", self.pix_fmt, "pipe:1"]
+
+    def run(self, cmd, out, count):
+        """Run an ffmpeg command and read `count` raw frames from it into `out`."""
+        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        complete = all(read_exact(process.stdout, out[i]) for i in range(count))
+        process.stdout.close()
+        stderr = process.stderr.read().decode("utf-8", errors="ignore")
+        process.wait()
+
+        if not complete:
+            raise RuntimeError(f"ffmpeg returned fewer than {count} frames for {self.input_file}: {stderr.strip()}")
+        return out
+
+    def grab(self, start_time, out=None, exact=True):
+        """
+        Decode a single frame at `start_time` seconds.
+        The frame is written into `out` (or the reader's own buffer) and returned,
+        so callers that need to keep it must copy it before the next grab.
+        """
+        out = self.buffer if out is None else out
+        cmd = [
+            FFMPEG, "-v", "error",
+            *seek_input_args(self.input_file, start_time, exact),
+            "-frames:v", "1",
+            *self.raw_args()
+        ]
+        return self.run(cmd, out[np.newaxis], 1)[0]
+
+    def grab_many(self, timestamps, out=None, exact=False):
+        """
+        Decode one frame per timestamp into an (N, height, width[, channels]) stack.
+        Each timestamp becomes its own input-side seek, and up to MAX_SEEK_INPUTS of
+        them are joined with the concat filter so one ffmpeg process serves the batch.
+        """
+        timestamps = list(timestamps)
+        if out is None:
+            out = np.empty((len(timestamps),) + self.shape, dtype=np.uint8)
+
+        for offset in range(0, len(timestamps), MAX_SEEK_INPUTS):
+            batch = timestamps[offset:offset + MAX_SEEK_INPUTS]
+            cmd = [FFMPEG, "-v", "error"]
+            for start_time in batch:
+                cmd += seek_input_args(self.input_file, start_time, exact)
+
+            trims = "".join(
+                f"[{i}:v:0]trim=end_frame=1,setpts=PTS-STARTPTS[f{i}];" for i in range(len(batch))
+            )
+            labels = "".join(f"[f{i}]" for i in range(len(batch)))
+            cmd += [
+                "-filter_complex", f"{trims}{labels}concat=n={len(batch)}:v=1:a=0[out]",
+                "-map", "[out]", "-fps_mode", "passthrough",
+                "-frames:v", str(len(batch)),
+                *self.raw_args()
+            ]
+            self.run(cmd, out[offset:offset + len(batch)], len(batch))
+        return out
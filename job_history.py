@@ -0,0 +1,107 @@
+import os
+import json
+import math
+import time
+import sqlite3
+from contextlib import closing
+import cache
+import frames
+
+
+# ========== CONFIGURATION ==========
+DB_FILE = "job_history.sqlite"
+
+# How far apart two sources are in each feature before they stop looking alike
+FEATURE_SCALES = {
+    "log_bitrate": 0.25,   # ~28% difference in source bitrate
+    "active_area": 0.08,   # share of the frame left after cropping
+    "source_height": 360,
+    "log_duration": 0.3,
+}
+
+# Neighbours averaged for a prediction, and the fewest jobs needed to predict at all
+NEIGHBOURS = 7
+MIN_NEIGHBOURS = 3
+
+
+# ====================================
+
+def connect():
+    conn = sqlite3.connect(cache.cache_path(DB_FILE), timeout=30)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        " source TEXT NOT NULL,"
+        " res TEXT NOT NULL,"
+        " features TEXT NOT NULL,"
+        " cq INTEGER NOT NULL,"
+        " bitrate INTEGER NOT NULL,"
+        " created REAL NOT NULL,"
+        " PRIMARY KEY (source, res))"
+    )
+    return conn
+
+
+def source_features(input_file, approved_crop):
+    """Cheap features of a source that the chosen CQ correlates with (no decoding)."""
+    width, height = frames.probe_video_size(input_file)
+    duration = frames.probe_duration(input_file)
+    top, bottom, left, right = (int(v) for v in approved_crop.split(":"))
+    return {
+        "log_bitrate": math.log(max(1.0, os.path.getsize(input_file) * 8 / duration / 1000)),
+        "active_area": (width - left - right) * (height - top - bottom) / (width * height),
+        "source_height": height,
+        "log_duration": math.log(max(1.0, duration)),
+    }
+
+
+def record(input_file, res, approved_crop, cq, bitrate):
+    """Store the CQ a finished final encode used and the bitrate it landed at."""
+    features = source_features(input_file, approved_crop)
+    with closing(connect()) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO jobs (source, res, features, cq, bitrate, created) VALUES (?, ?, ?, ?, ?, ?)",
+            (cache.source_fingerprint(input_file), res, json.dumps(features), int(cq), int(bitrate), time.time())
+        )
+
+
+def feature_distance(a, b):
+    return math.sqrt(sum(((a[name] - b[name]) / scale) ** 2 for name, scale in FEATURE_SCALES.items()))
+
+
+def predict_from_neighbours(features, res):
+    """Distance-weighted CQ of the most similar past jobs at `res`, or None with too little history."""
+    with closing(connect()) as conn:
+        rows = conn.execute("SELECT features, cq FROM jobs WHERE res = ?", (res,)).fetchall()
+    if len(rows) < MIN_NEIGHBOURS:
+        return None
+    nearest = sorted((feature_distance(features, json.loads(f)), cq) for f, cq in rows)[:NEIGHBOURS]
+    weights = [1 / (1 + distance ** 2) for distance, _ in nearest]
+    return sum(w * cq for w, (_, cq) in zip(weights, nearest)) / sum(weights)
+
+
+def resolution_offset(res, known_res):
+    """Median CQ difference between `res` and `known_res` over sources encoded at both (0 without any)."""
+    with closing(connect()) as conn:
+        rows = conn.execute(
+            "SELECT a.cq - b.cq FROM jobs a JOIN jobs b ON a.source = b.source WHERE a.res = ? AND b.res = ?",
+            (res, known_res)
+        ).fetchall()
+    if not rows:
+        return 0
+    offsets = sorted(offset for offset, in rows)
+    middle = len(offsets) // 2
+    return offsets[middle] if len(offsets) % 2 else (offsets[middle - 1] + offsets[middle]) / 2
+
+
+def predict_cq(input_file, res, approved_crop, known_cqs=None):
+    """
+    CQ to start the preview search at, or None without a basis for a guess.
+    A CQ already found for another resolution of this job (720p first) wins, shifted by
+    the usual difference between the two resolutions; otherwise the CQs of past jobs
+    with the most similar sources are averaged.
+    """
+    known_cqs = {r: cq for r, cq in (known_cqs or {}).items() if cq is not None and r != res}
+    if known_cqs:
+        known_res = "720p" if "720p" in known_cqs else next(iter(known_cqs))
+        return known_cqs[known_res] + resolution_offset(res, known_res)
+    return predict_from_neighbours(source_features(input_file, approved_crop), res)
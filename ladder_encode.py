@@ -0,0 +1,58 @@
+import os
+import subprocess
+from dotenv import load_dotenv
+import encoders
+import preview_executor
+
+
+load_dotenv()
+
+
+def ladder_filter_graph(approved_crop, widths):
+    """
+    Filter graph that crops the decoded source once and splits it into one scaled
+    stream per target width, labelled [v0], [v1], ... in the order given.
+    """
+    splits = "".join(f"[s{i}]" for i in range(len(widths)))
+    graph = [f"[0:v]{encoders.crop_filter(approved_crop)},split={len(widths)}{splits}"]
+    for i, width in enumerate(widths):
+        graph.append(f"[s{i}]{encoders.scale_filter(width)}[v{i}]")
+    return ";".join(graph)
+
+
+def ladder_command(input_file, approved_crop, rungs, threads=None):
+    """
+    ffmpeg command that decodes `input_file` once and writes every rung of the ladder.
+
+    Each rung is a dict with "output", "width", "cq" and "encopts" (x264 options in
+    HandBrake --encopts form, which libx264 takes unchanged through -x264-params).
+    Audio, subtitles and chapters are left out, like the HandBrake final encode.
+    """
+    cmd = [encoders.FFMPEG, "-hide_banner", "-y", "-i", input_file,
+           "-filter_complex", ladder_filter_graph(approved_crop, [rung["width"] for rung in rungs])]
+    for i, rung in enumerate(rungs):
+        encopts = rung["encopts"] + (f":threads={threads}" if threads else "")
+        cmd += ["-map", f"[v{i}]", *encoders.x264_output_args(rung["cq"], encopts=encopts), rung["output"]]
+    return cmd
+
+
+def encode_ladder(input_file, approved_crop, rungs, log_path, on_line=None):
+    """
+    Encode every rung of the ladder in a single pass over the source.
+    One decode and one crop feed a scaler and an x264 encoder per rung, all running
+    at once, so the source is read and decoded once instead of once per resolution.
+    The CPU is split evenly between the encoders. Returns True on success.
+    """
+    for rung in rungs:
+        os.makedirs(os.path.dirname(rung["output"]), exist_ok=True)
+    threads = preview_executor.thread_budget(len(rungs))
+    command = ladder_command(input_file, approved_crop, rungs, threads)
+
+    with open(log_path, "w", encoding="utf-8", errors="ignore") as log_file:
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   text=True, encoding="utf-8", errors="ignore")
+        for line in process.stdout:
+            log_file.write(line)
+            if on_line:
+                on_line(line)
+        return process.wait() == 0
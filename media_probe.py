@@ -0,0 +1,167 @@
+import os
+import json
+import hashlib
+import threading
+import subprocess
+from dotenv import load_dotenv
+import cache
+
+
+load_dotenv()
+
+# ========== CONFIGURATION ==========
+FFPROBE = os.getenv("FFPROBE") or "ffprobe"
+
+# Subdirectory of the cache directory holding one probe per file
+PROBE_DIR = "probes"
+
+# Least recently used probes beyond this count are evicted
+MAX_PROBES = int(os.getenv("PROBE_CACHE_MAX_ENTRIES") or 5000)
+
+# Probes not used for this many days are evicted
+MAX_AGE_DAYS = float(os.getenv("PROBE_CACHE_MAX_AGE_DAYS") or 90)
+
+# Eviction runs on a process's first stored probe and then after every this many more
+EVICT_EVERY = 100
+
+
+# ====================================
+
+_probes = {}
+_stored = 0
+_lock = threading.Lock()
+
+
+def file_key(path):
+    """(absolute path, size, mtime): a probe is valid as long as all three are unchanged."""
+    stat = os.stat(path)
+    return os.path.abspath(path), stat.st_size, stat.st_mtime
+
+
+def run_probe(path):
+    """One structured ffprobe of a file: format, every stream and the chapters."""
+    cmd = [
+        FFPROBE, "-v", "error",
+        "-show_format", "-show_streams", "-show_chapters",
+        "-of", "json", path
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True, encoding="utf-8", errors="ignore")
+    if result.returncode != 0:
+        raise RuntimeError(f"ffprobe failed for {path}: {result.stderr.strip()}")
+    return json.loads(result.stdout)
+
+
+def probe(path):
+    """
+    Parsed ffprobe output of a file, probed at most once.
+    Results are kept in memory and in the cache directory keyed by path, size and
+    mtime, so a file on a network share is opened once per change, not once per
+    question asked about it. Files in the scratch directory (previews, chunks) are
+    short-lived and only kept in memory.
+    """
+    key = file_key(path)
+    with _lock:
+        if key in _probes:
+            return _probes[key]
+
+    if cache.in_scratch(path):
+        data = run_probe(path)
+    else:
+        data = stored_probe(key)
+
+    with _lock:
+        _probes[key] = data
+    return data
+
+
+def stored_probe(key):
+    """Probe of a file from the cache directory, running and storing it when missing or stale."""
+    global _stored
+    cache_file = cache.cache_path(PROBE_DIR, hashlib.sha1(key[0].encode("utf-8")).hexdigest() + ".json")
+    stored = cache.load_json(cache_file, None)
+    if stored and [stored["path"], stored["size"], stored["mtime"]] == list(key):
+        # A probe file's mtime records when it was last used
+        os.utime(cache_file)
+        return stored["probe"]
+
+    data = run_probe(key[0])
+    cache.save_json(cache_file, {"path": key[0], "size": key[1], "mtime": key[2], "probe": data})
+    with _lock:
+        due = _stored % EVICT_EVERY == 0
+        _stored += 1
+    if due:
+        cache.evict_files(PROBE_DIR, MAX_PROBES, MAX_AGE_DAYS)
+    return data
+
+
+def streams(path, codec_type=None):
+    """Streams of a file, optionally only those of one type ("video", "audio", "subtitle")."""
+    return [s for s in probe(path).get("streams", []) if codec_type is None or s.get("codec_type") == codec_type]
+
+
+def video_stream(path):
+    video = streams(path, "video")
+    if not video:
+        raise RuntimeError(f"No video stream in {path}")
+    return video[0]
+
+
+def duration(path):
+    """Container duration in seconds."""
+    return float(probe(path)["format"]["duration"])
+
+
+def start_delay_ms(path, stream):
+    """
+    Milliseconds a stream starts after the file's video (negative when it starts
+    before), i.e. the delay a demuxed copy of it needs to stay in sync.
+    """
+    start = float(stream.get("start_time") or 0)
+    video_start = float(video_stream(path).get("start_time") or 0)
+    return round((start - video_start) * 1000)
+
+
+def bitrate_kbps(path):
+    """Overall bitrate of a file in Kbps, or None if the container does not state one."""
+    bit_rate = probe(path).get("format", {}).get("bit_rate")
+    return int(bit_rate) // 1000 if bit_rate else None
+
+
+def language(stream):
+    return stream.get("tags", {}).get("language") or "und"
+
+
+def display_aspect_ratio(stream):
+    """Display aspect ratio of a video stream as a float, from its DAR or its size and SAR."""
+    dar = stream.get("display_aspect_ratio")
+    if dar and not dar.startswith("0:"):
+        num, den = dar.split(":")
+        return int(num) / int(den)
+    sar = stream.get("sample_aspect_ratio") or "1:1"
+    num, den = sar.split(":")
+    sar_value = int(num) / int(den) if int(num) and int(den) else 1.0
+    return int(stream["width"]) * sar_value / int(stream["height"])
+
+
+def channel_layout(stream):
+    """Channel layout in eac3to's form, e.g. "5.1" or "2.0"."""
+    channels = int(stream.get("channels") or 0)
+    return {1: "1.0", 2: "2.0", 6: "5.1", 7: "6.1", 8: "7.1"}.get(channels, f"{channels}.0")
+
+
+def audio_codec(stream):
+    """Codec of an audio stream named the way eac3to lists it ("DTS-HD MA", "TrueHD", "LPCM", ...)."""
+    name = stream.get("codec_name") or ""
+    profile = stream.get("profile") or ""
+    if name == "dts":
+        if "MA" in profile:
+            return "DTS-HD MA"
+        return "DTS-HD HRA" if "HRA" in profile else "DTS"
+    if name.startswith("pcm_"):
+        return "LPCM"
+    return {"truehd": "TrueHD", "flac": "FLAC", "ac3": "AC3", "eac3": "E-AC3", "aac": "AAC"}.get(name, name.upper())
+
+
+def describe_audio(stream):
+    """eac3to-style track description, e.g. "DTS-HD MA, hin, 5.1 channels"."""
+    return f"{audio_codec(stream)}, {language(stream)}, {channel_layout(stream)} channels"
@@ -0,0 +1,38 @@
+import os
+import subprocess
+import cache
+import frames
+
+
+# ====================================
+
+def cut_preview_clip(input_file, start_seconds, duration):
+    """
+    Stream-copy one preview window of the source into a local scratch clip.
+    The cut starts on the keyframe at or before `start_seconds`, nothing is re-encoded,
+    and an existing clip is reused, so every CQ probe and every resolution encodes
+    from the same small local file instead of seeking the remux on the network share.
+    """
+    clip_file = cache.scratch_path(input_file, "previews", f"clip_{start_seconds}_{duration}.mkv")
+    if os.path.exists(clip_file):
+        return clip_file
+
+    temp_file = f"{clip_file}.part.mkv"
+    cmd = [
+        frames.FFMPEG, "-v", "error", "-y",
+        "-ss", str(start_seconds), "-i", input_file,
+        "-t", str(duration),
+        "-map", "0:v:0", "-c", "copy",
+        "-avoid_negative_ts", "make_zero",
+        temp_file
+    ]
+    result = subprocess.run(cmd, capture_output=True, text=True)
+    if result.returncode != 0 or not os.path.exists(temp_file):
+        raise RuntimeError(f"Failed to cut preview clip at {start_seconds}s: {result.stderr.strip()}")
+    os.replace(temp_file, clip_file)
+    return clip_file
+
+
+def cut_preview_clips(input_file, starts, duration):
+    """Cut (or reuse) a clip for every preview start and return {start_seconds: clip path}."""
+    return {start: cut_preview_clip(input_file, start, duration) for start in starts}
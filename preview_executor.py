@@ -0,0 +1,47 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+# ========== CONFIGURATION ==========
+# Most preview encodes allowed to run at the same time
+MAX_PARALLEL_PREVIEWS = int(os.getenv("MAX_PARALLEL_PREVIEWS") or 6)
+
+# x264 gets at least this many threads per encode, however many run at once
+MIN_THREADS_PER_ENCODE = 4
+
+
+# ====================================
+
+def thread_budget(concurrent, cpu_count=None):
+    """x264 threads for each of `concurrent` encodes so together they fill the machine."""
+    cpu_count = cpu_count or os.cpu_count() or 1
+    return max(MIN_THREADS_PER_ENCODE, cpu_count // max(1, concurrent))
+
+
+class PreviewExecutor:
+    """
+    Runs preview encodes concurrently in a bounded pool.
+
+    `encode` is called once per task with the task's keyword arguments plus
+    `threads`, and must return the measured bitrate (or None). Every encode is its
+    own encoder process; the pool only waits on them, so `max_workers` bounds how
+    many encoder processes run at once and `threads` is the x264 thread budget each
+    of them gets.
+    """
+
+    def __init__(self, encode, max_workers=MAX_PARALLEL_PREVIEWS):
+        self.encode = encode
+        self.max_workers = max(1, max_workers)
+
+    def run(self, tasks):
+        """Encode every task and return their bitrates in task order."""
+        if not tasks:
+            return []
+        workers = min(self.max_workers, len(tasks))
+        threads = thread_budget(workers)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(self.encode, threads=threads, **task) for task in tasks]
+            return [future.result() for future in futures]
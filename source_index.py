@@ -0,0 +1,296 @@
+import os
+import re
+import shutil
+import subprocess
+import numpy as np
+from dotenv import load_dotenv
+import cache
+import cropdetect
+import frames
+
+
+load_dotenv()
+
+# ========== CONFIGURATION ==========
+# Build the analysis index at the start of every job (0 = stages sample the source themselves)
+SOURCE_ANALYSIS = (os.getenv("SOURCE_ANALYSIS") or "1") != "0"
+
+# Thumbnail size used for per-frame luma statistics and frame differences
+ANALYSIS_SIZE = (64, 36)
+
+# Full-resolution row/column black profiles are kept for every Nth frame (~1 per second)
+PROFILE_EVERY = 24
+
+# Frames either side used as the local baseline of the scene-cut score
+CUT_WINDOW = 12
+
+# Thumbnails processed per chunk while reducing them to statistics
+CHUNK_FRAMES = 4096
+
+# Preview windows darker than this on average (fades, black credits) are never picked
+MIN_WINDOW_LUMA = 24
+
+# Share of the runtime at each end (logos, credits) left out of preview window selection
+WINDOW_MARGIN = 0.05
+
+# Bumped whenever the index layout changes, so old indexes are rebuilt
+INDEX_VERSION = 1
+
+FRAME_DTYPE = np.dtype([
+    ("time", "f8"),     # seconds from the first frame, as ffmpeg -ss counts
+    ("size", "i4"),     # coded frame size in bytes
+    ("key", "?"),       # keyframe
+    ("mean", "f4"),     # luma mean
+    ("std", "f4"),      # luma standard deviation
+    ("diff", "f4"),     # mean absolute luma difference to the previous frame
+    ("cut", "f4"),      # diff relative to its neighbourhood, high at scene cuts
+])
+
+
+# ====================================
+
+def index_dir(input_file):
+    """The index lives next to the source, so every job and every node finds it."""
+    stem = os.path.splitext(os.path.basename(input_file))[0]
+    return os.path.join(os.path.dirname(input_file), f"{stem}.analysis")
+
+
+def parse_packets(packet_log):
+    """(time, size, key) for every video packet from an ffmpeg framecrc log, in presentation order."""
+    time_base = 1.0
+    packets = []
+    with open(packet_log, "r", encoding="utf-8", errors="ignore") as f:
+        for line in f:
+            if line.startswith("#tb 0:"):
+                num, den = line.split(":", 1)[1].strip().split("/")
+                time_base = int(num) / int(den)
+                continue
+            if line.startswith("#"):
+                continue
+            fields = [field.strip() for field in line.split(",")]
+            if len(fields) < 6 or fields[0] != "0":
+                continue
+            # framecrc marks every packet that is not a plain keyframe with F=0x..
+            flags = re.search(r"F=0x([0-9A-Fa-f]+)", line)
+            key = flags is None or int(flags.group(1), 16) & 1 == 1
+            packets.append((int(fields[2]) * time_base, int(fields[4]), key))
+    packets.sort()
+    return packets
+
+
+def cut_scores(diff, window=CUT_WINDOW):
+    """Frame difference divided by the median difference around it, so only abrupt changes score high."""
+    padded = np.pad(diff, window, mode="edge")
+    baseline = np.median(np.lib.stride_tricks.sliding_window_view(padded, 2 * window + 1), axis=1)
+    return diff / (baseline + 1.0)
+
+
+def thumbnail_stats(thumb_file, count):
+    """Per-frame luma mean, standard deviation and difference to the previous frame."""
+    width, height = ANALYSIS_SIZE
+    thumbs = np.memmap(thumb_file, dtype=np.uint8, mode="r", shape=(count, height, width))
+    mean = np.empty(count, dtype=np.float32)
+    std = np.empty(count, dtype=np.float32)
+    diff = np.zeros(count, dtype=np.float32)
+    previous = None
+    for start in range(0, count, CHUNK_FRAMES):
+        chunk = thumbs[start:start + CHUNK_FRAMES].astype(np.float32)
+        mean[start:start + len(chunk)] = chunk.mean(axis=(1, 2))
+        std[start:start + len(chunk)] = chunk.std(axis=(1, 2))
+        with_previous = chunk if previous is None else np.concatenate([previous, chunk])
+        changes = np.abs(np.diff(with_previous, axis=0)).mean(axis=(1, 2))
+        diff[start + (1 if previous is None else 0):start + len(chunk)] = changes
+        previous = chunk[-1:]
+    del thumbs
+    return mean, std, diff
+
+
+def build_index(input_file):
+    """
+    Analyse the source in one read and one decode and write its index.
+
+    A single ffmpeg run stream-copies the video into a packet log (timestamps, sizes,
+    keyframe flags) and decodes it once, feeding a gray thumbnail of every frame and
+    full-resolution row/column content profiles (share of pixels brighter than black)
+    of every PROFILE_EVERY-th frame into raw files in scratch. These are reduced to
+    the index: a structured per-frame array plus the profile arrays, all .npy files
+    that later stages memory-map.
+    """
+    width, height = frames.probe_video_size(input_file)
+    work_dir = cache.scratch_dir(input_file, "analysis")
+    packet_log = os.path.join(work_dir, "packets.txt")
+    thumb_file = os.path.join(work_dir, "thumbs.raw")
+    rows_file = os.path.join(work_dir, "rows.raw")
+    cols_file = os.path.join(work_dir, "cols.raw")
+
+    thumb_width, thumb_height = ANALYSIS_SIZE
+    graph = (
+        f"[0:v:0]format=gray,split=2[t][p];"
+        f"[t]scale={thumb_width}:{thumb_height}:flags=area[thumbs];"
+        f"[p]select='not(mod(n\\,{PROFILE_EVERY}))',"
+        f"lut=y='if(gt(val\\,{cropdetect.BLACK_THRESHOLD})\\,255\\,0)',split=2[r][c];"
+        f"[r]scale=1:ih:flags=area,transpose=1[rows];"
+        f"[c]scale=iw:1:flags=area[cols]"
+    )
+    cmd = [
+        frames.FFMPEG, "-v", "error", "-y", "-i", input_file,
+        "-map", "0:v:0", "-c", "copy", "-f", "framecrc", packet_log,
+        "-filter_complex", graph,
+    ]
+    for label, path in (("thumbs", thumb_file), ("rows", rows_file), ("cols", cols_file)):
+        cmd += ["-map", f"[{label}]", "-fps_mode", "passthrough", "-f", "rawvideo", "-pix_fmt", "gray", path]
+    print(f"🔬 Analysing {os.path.basename(input_file)} in one decode pass...")
+    result = subprocess.run(cmd, capture_output=True, text=True, encoding="utf-8", errors="ignore")
+    if result.returncode != 0:
+        raise RuntimeError(f"Source analysis failed: {result.stderr.strip()}")
+
+    packets = parse_packets(packet_log)
+    count = min(len(packets), os.path.getsize(thumb_file) // (thumb_width * thumb_height))
+    profiles = min(os.path.getsize(rows_file) // height, os.path.getsize(cols_file) // width)
+    if count == 0 or profiles == 0:
+        raise RuntimeError(f"Source analysis decoded no frames ({len(packets)} packets, {profiles} profiles)")
+
+    index = np.zeros(count, dtype=FRAME_DTYPE)
+    index["time"], index["size"], index["key"] = zip(*packets[:count])
+    index["time"] -= index["time"][0]
+    index["mean"], index["std"], index["diff"] = thumbnail_stats(thumb_file, count)
+    index["cut"] = cut_scores(index["diff"])
+
+    # Write to a temporary directory and swap it in, so a half-written index is never loaded
+    target = index_dir(input_file)
+    temp_dir = f"{target}.tmp"
+    shutil.rmtree(temp_dir, ignore_errors=True)
+    os.makedirs(temp_dir)
+    np.save(os.path.join(temp_dir, "frames.npy"), index)
+    np.save(os.path.join(temp_dir, "rows.npy"), np.fromfile(rows_file, dtype=np.uint8, count=profiles * height).reshape(profiles, height))
+    np.save(os.path.join(temp_dir, "cols.npy"), np.fromfile(cols_file, dtype=np.uint8, count=profiles * width).reshape(profiles, width))
+    cache.save_json(os.path.join(temp_dir, "meta.json"), {
+        "version": INDEX_VERSION,
+        "source": cache.source_fingerprint(input_file),
+        "width": width, "height": height,
+        "frames": count, "profile_every": PROFILE_EVERY,
+    })
+    shutil.rmtree(target, ignore_errors=True)
+    os.replace(temp_dir, target)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    print(f"✅ Indexed {count} frames ({profiles} profiles)")
+
+
+def load_index(input_file):
+    """The source's index if one exists for exactly this file and index version, otherwise None."""
+    directory = index_dir(input_file)
+    meta = cache.load_json(os.path.join(directory, "meta.json"), None)
+    if not meta or meta.get("version") != INDEX_VERSION or meta.get("source") != cache.source_fingerprint(input_file):
+        return None
+    return SourceIndex(directory, meta)
+
+
+def get_index(input_file, build=SOURCE_ANALYSIS):
+    """Load the source's index, building it first if allowed. None if there is none."""
+    index = load_index(input_file)
+    if index is None and build:
+        build_index(input_file)
+        index = load_index(input_file)
+    return index
+
+
+class SourceIndex:
+    """
+    Memory-mapped analysis of one source: per-frame statistics in `frames` and
+    full-resolution content profiles of every `profile_every`-th frame in `rows`
+    (N, height) and `cols` (N, width), stored as 0-255 content shares.
+    """
+
+    def __init__(self, directory, meta):
+        self.meta = meta
+        self.frames = np.load(os.path.join(directory, "frames.npy"), mmap_mode="r")
+        self.rows = np.load(os.path.join(directory, "rows.npy"), mmap_mode="r")
+        self.cols = np.load(os.path.join(directory, "cols.npy"), mmap_mode="r")
+        self.profile_every = meta["profile_every"]
+
+    @property
+    def duration(self):
+        times = self.frames["time"]
+        return float(times[-1]) if len(times) else 0.0
+
+    def profile_frames(self):
+        """Rows of `frames` that have a profile, in profile order."""
+        count = min(len(self.rows), len(self.cols))
+        return self.frames[::self.profile_every][:count]
+
+    def keyframe_times(self):
+        return [float(t) for t in self.frames["time"][self.frames["key"]]]
+
+    def scene_cut_times(self, threshold=4.0):
+        """Times of frames whose difference stands out from their neighbourhood."""
+        return [float(t) for t in self.frames["time"][self.frames["cut"] >= threshold]]
+
+    def detect_crop(self):
+        """Crop voted over every profiled frame, in the same form as cropdetect.detect_crop."""
+        count = len(self.profile_frames())
+        rows = np.asarray(self.rows[:count], dtype=np.float32) / 255
+        cols = np.asarray(self.cols[:count], dtype=np.float32) / 255
+        return cropdetect.detect_crop_from_profiles(rows, cols)
+
+    def best_lit_time(self, start=None, end=None):
+        """Time of the frame with the highest brightness plus contrast between `start` and `end`."""
+        times = self.frames["time"]
+        mask = np.ones(len(times), dtype=bool)
+        if start is not None:
+            mask &= times >= start
+        if end is not None:
+            mask &= times <= end
+        if not mask.any():
+            return None
+        scores = np.where(mask, self.frames["mean"] + self.frames["std"], -np.inf)
+        return float(times[int(scores.argmax())])
+
+    def screenshot_times(self, count=3, skip=300):
+        """Best-lit frame in each of `count` equal parts of the film, after skipping the first `skip` seconds."""
+        offset = skip if self.duration > skip else 0
+        span = (self.duration - offset) / count
+        times = [self.best_lit_time(offset + i * span, offset + (i + 1) * span) for i in range(count)]
+        return [t for t in times if t is not None]
+
+    def preview_windows(self, count, length):
+        """
+        Stratified preview windows: [(start seconds, weight)] in time order.
+
+        The film (minus WINDOW_MARGIN at each end and near-black stretches) is cut into
+        back-to-back windows of `length` seconds, each scored by its mean coded frame size
+        as the complexity estimate. Sorted by complexity, the windows are split into
+        `count` strata holding an equal share of the coded bits, so the few complex
+        stretches that drive the bitrate get strata of their own while the long easy ones
+        share one. Each stratum is represented by the window closest to its mean
+        complexity, weighted by the stratum's share of the runtime, i.e. how much of the
+        film its bitrate stands for. Short titles get fewer windows.
+        """
+        times = self.frames["time"]
+        margin = self.duration * WINDOW_MARGIN
+        starts = np.arange(margin, self.duration - margin - length, length)
+        if len(starts) == 0:
+            return [(0, 1.0)]
+
+        first = np.searchsorted(times, starts)
+        last = np.searchsorted(times, starts + length)
+        sizes = np.asarray(self.frames["size"], dtype=np.float64)
+        luma = np.asarray(self.frames["mean"], dtype=np.float64)
+        complexity = np.array([sizes[a:b].mean() if b > a else 0.0 for a, b in zip(first, last)])
+        brightness = np.array([luma[a:b].mean() if b > a else 0.0 for a, b in zip(first, last)])
+
+        candidates = np.flatnonzero((brightness >= MIN_WINDOW_LUMA) & (complexity > 0))
+        if len(candidates) == 0:
+            candidates = np.arange(len(starts))
+        order = candidates[np.argsort(complexity[candidates], kind="stable")]
+
+        # A new stratum starts at the window that reaches the next multiple of total bits / count
+        bits = np.cumsum(complexity[order])
+        targets = bits[-1] * np.arange(1, min(count, len(order))) / min(count, len(order))
+        strata = [stratum for stratum in np.split(order, np.unique(np.searchsorted(bits, targets))) if len(stratum)]
+
+        windows = []
+        for stratum in strata:
+            mean = complexity[stratum].mean()
+            chosen = stratum[np.abs(complexity[stratum] - mean).argmin()]
+            windows.append((int(starts[chosen]), len(stratum) / len(order)))
+        return sorted(windows)
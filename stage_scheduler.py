@@ -0,0 +1,107 @@
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+# ========== CONFIGURATION ==========
+# Stages of one job allowed to run at the same time, per resource class
+STAGE_LIMITS = {
+    "cpu": int(os.getenv("MAX_CPU_STAGES") or 1),          # preview searches and video encodes, each fills the machine
+    "io": int(os.getenv("MAX_IO_STAGES") or 2),            # demuxing, audio, muxing, screenshots, MediaInfo
+    "network": int(os.getenv("MAX_NETWORK_STAGES") or 2),  # IMDb and PTP lookups
+}
+
+
+# ====================================
+
+class SkipStage(Exception):
+    """Raised by a stage with nothing to do; the stages that depend on it are skipped, not failed."""
+
+
+class Stage:
+    def __init__(self, name, func, resource, after):
+        self.name = name
+        self.func = func
+        self.resource = resource
+        self.after = after
+        self.state = "pending"  # pending, running, done, skipped or failed
+        self.result = None
+        self.error = None
+
+
+class StageGraph:
+    """
+    A job's pipeline as a dependency graph of stages.
+
+    Each stage is a callable without arguments (read earlier results with `result`)
+    in a resource class ("cpu", "io" or "network"). `run` starts every stage as soon
+    as the stages it comes after have finished, as long as its class is below its
+    limit, so e.g. audio and IMDb/PTP lookups overlap the video encode. Stages are
+    started in the order they were added when several are ready.
+    """
+
+    def __init__(self, limits=None):
+        self.limits = {resource: max(1, limit) for resource, limit in dict(STAGE_LIMITS, **(limits or {})).items()}
+        self.stages = {}
+
+    def add(self, name, func, resource="cpu", after=()):
+        """Add a stage running after the (already added) stages `after`; returns its name."""
+        if name in self.stages:
+            raise ValueError(f"Duplicate stage: {name}")
+        if resource not in self.limits:
+            raise ValueError(f"Unknown resource class: {resource}")
+        missing = [dependency for dependency in after if dependency not in self.stages]
+        if missing:
+            raise ValueError(f"Stage {name} comes after unknown stages: {missing}")
+        self.stages[name] = Stage(name, func, resource, list(after))
+        return name
+
+    def result(self, name):
+        return self.stages[name].result
+
+    def ready(self, stage, busy):
+        states = [self.stages[dependency].state for dependency in stage.after]
+        if any(state in ("skipped", "failed") for state in states):
+            stage.state = "skipped"
+            return False
+        return all(state == "done" for state in states) and busy[stage.resource] < self.limits[stage.resource]
+
+    def run(self):
+        """
+        Run every stage and return {name: result}. A stage whose dependency failed or
+        was skipped is skipped; the others still run, and the first failure is raised
+        once they have finished.
+        """
+        busy = {resource: 0 for resource in self.limits}
+        running = {}
+        with ThreadPoolExecutor(max_workers=sum(self.limits.values())) as pool:
+            while True:
+                # Stages were added after their dependencies, so one pass settles every skip
+                for stage in self.stages.values():
+                    if stage.state == "pending" and self.ready(stage, busy):
+                        stage.state = "running"
+                        busy[stage.resource] += 1
+                        running[pool.submit(stage.func)] = stage
+                if not running:
+                    break
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    busy[stage.resource] -= 1
+                    try:
+                        stage.result = future.result()
+                        stage.state = "done"
+                    except SkipStage as e:
+                        stage.state = "skipped"
+                        print(f"⏩ Stage {stage.name} skipped: {e}")
+                    except Exception as e:
+                        stage.error = e
+                        stage.state = "failed"
+                        print(f"❌ Stage {stage.name} failed: {e}")
+
+        failed = [stage for stage in self.stages.values() if stage.state == "failed"]
+        if failed:
+            raise RuntimeError(f"Stages failed: {', '.join(stage.name for stage in failed)}") from failed[0].error
+        return {name: stage.result for name, stage in self.stages.items()}
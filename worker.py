@@ -0,0 +1,145 @@
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+import subprocess
+import requests
+from dotenv import load_dotenv
+
+
+load_dotenv()
+
+# ========== CONFIGURATION ==========
+# Executables on this node, looked up by the tool name a task asks for
+TOOLS = {
+    "handbrake": os.getenv("HANDBRAKE_CLI") or "HandBrakeCLI",
+    "ffmpeg": os.getenv("FFMPEG") or "ffmpeg",
+}
+FFPROBE = os.getenv("FFPROBE") or "ffprobe"
+
+HEARTBEAT_INTERVAL = float(os.getenv("WORKER_HEARTBEAT_INTERVAL") or 15)
+IDLE_POLL_INTERVAL = float(os.getenv("WORKER_POLL_INTERVAL") or 5)
+
+# Lines of encoder output sent back with each result
+LOG_TAIL_LINES = 200
+
+
+# ====================================
+
+def output_stats(output_file):
+    """get_bitrate-style stats for a finished output: bitrate in Kbps and video frame count."""
+    cmd = [
+        FFPROBE, "-v", "error", "-select_streams", "v:0", "-count_packets",
+        "-show_entries", "format=bit_rate:stream=nb_read_packets",
+        "-of", "default=noprint_wrappers=1", output_file
+    ]
+    try:
+        result = subprocess.run(cmd, capture_output=True, text=True)
+    except OSError:
+        return {"bitrate": None, "frames": None}
+    values = dict(line.split("=", 1) for line in result.stdout.splitlines() if "=" in line)
+    try:
+        bitrate = int(values["bit_rate"]) // 1000
+    except (KeyError, ValueError):
+        bitrate = None
+    try:
+        frames = int(values["nb_read_packets"])
+    except (KeyError, ValueError):
+        frames = None
+    return {"bitrate": bitrate, "frames": frames}
+
+
+def run_task(task):
+    """Run a task's encoder command and return the result reported to the coordinator."""
+    payload = task["payload"]
+    command = [TOOLS[payload["tool"]], *payload["args"]]
+    print(f"🎬 Running {task['kind']} task {task['id']}: {' '.join(command)}")
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             text=True, encoding="utf-8", errors="ignore")
+    log_lines = process.stdout.splitlines()[-LOG_TAIL_LINES:]
+    result = {"ok": process.returncode == 0, "log": "\n".join(log_lines)}
+    result.update(output_stats(payload["output"]) if os.path.exists(payload["output"]) else {"bitrate": None, "frames": None})
+    return result
+
+
+class Worker:
+    """
+    Worker agent: registers with a coordinator, pulls tasks, runs them and reports
+    back, sending heartbeats from a background thread while it works. Several can
+    run on one machine to stand in for remote nodes.
+    """
+
+    def __init__(self, coordinator_url, name, kinds=None):
+        self.url = coordinator_url.rstrip("/")
+        self.name = name
+        self.kinds = kinds
+        self.worker_id = None
+        self.lease = None
+        self.stopped = threading.Event()
+
+    def register(self):
+        # Passing the lease of the running task keeps it ours under the new worker id
+        response = requests.post(f"{self.url}/cluster/workers",
+                                 json={"name": self.name, "cores": os.cpu_count(), "lease": self.lease})
+        response.raise_for_status()
+        self.worker_id = response.json()["worker_id"]
+        print(f"✅ Registered {self.name} as {self.worker_id}")
+
+    def heartbeat_loop(self):
+        while not self.stopped.wait(HEARTBEAT_INTERVAL):
+            try:
+                response = requests.post(f"{self.url}/cluster/workers/{self.worker_id}/heartbeat")
+                if response.status_code == 404:
+                    self.register()
+            except requests.RequestException as e:
+                print(f"⚠️ Heartbeat failed: {e}")
+
+    def run(self):
+        self.register()
+        threading.Thread(target=self.heartbeat_loop, daemon=True).start()
+        while not self.stopped.is_set():
+            try:
+                response = requests.post(f"{self.url}/cluster/tasks/pull", json={"worker_id": self.worker_id, "kinds": self.kinds})
+            except requests.RequestException as e:
+                print(f"⚠️ Coordinator unreachable: {e}")
+                time.sleep(IDLE_POLL_INTERVAL)
+                continue
+            if response.status_code == 404:
+                self.register()
+                continue
+            if response.status_code == 204:
+                time.sleep(IDLE_POLL_INTERVAL)
+                continue
+
+            task = response.json()
+            self.lease = task["lease"]
+            try:
+                result = run_task(task)
+                error = None if result["ok"] else result["log"][-500:]
+            except Exception as e:
+                result, error = None, str(e)
+            self.report(task, result, error)
+            self.lease = None
+
+    def report(self, task, result, error):
+        """Send a task's result (or error) back under its lease."""
+        endpoint, body = ("fail", {"error": error}) if error else ("complete", {"result": result})
+        try:
+            response = requests.post(f"{self.url}/cluster/tasks/{task['id']}/{endpoint}", json={"lease": self.lease, **body})
+        except requests.RequestException as e:
+            print(f"⚠️ Could not report task {task['id']}: {e}")
+            return
+        if response.status_code == 409:
+            print(f"⚠️ Task {task['id']} was handed to another worker, result dropped")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Encode worker agent")
+    parser.add_argument("coordinator", help="Coordinator URL, e.g. http://192.168.254.97:5001")
+    parser.add_argument("--name", default=f"{socket.gethostname()}-{os.getpid()}")
+    parser.add_argument("--kinds", nargs="*", help="Only take these task kinds (chunk, preview, resolution)")
+    args = parser.parse_args()
+    sys.stdout.reconfigure(encoding='utf-8')
+    Worker(args.coordinator, args.name, args.kinds).run()